@@ -0,0 +1,132 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import logging
+import math
+import time
+
+
+class _EWMA(object):
+    # exponentially weighted moving average, weighted by the sample
+    # duration, with a half life in seconds
+
+    def __init__(self, half_life):
+        self._alpha = math.exp(math.log(0.5) / half_life)
+        self._estimate = 0.0
+        self._weight = 0.0
+
+    def sample(self, duration, value):
+        alpha = self._alpha ** duration
+        self._estimate = value * (1 - alpha) + alpha * self._estimate
+        self._weight += duration
+
+    def get(self):
+        # correct the bias towards the initial 0
+        zero_factor = 1 - self._alpha ** self._weight
+        return self._estimate / zero_factor
+
+
+class ThroughputEstimator(object):
+    # estimate the throughput in bits per second from the segment
+    # downloads, the lowest of a fast and a slow average is used so that
+    # drops are followed quickly and peaks are not. Parallel downloads
+    # share the link, so the bytes are measured over the time any of
+    # them runs, not over the time of each
+
+    MIN_BYTES = 16000 # smaller downloads mostly measure the latency
+    MIN_DURATION = 0.05
+
+    def __init__(self, fast=2.0, slow=5.0):
+        self._fast = _EWMA(fast)
+        self._slow = _EWMA(slow)
+        self._n_samples = 0
+        self._active = 0 # downloads running
+        self._bytes = 0 # received since _mark, not yet sampled
+        self._mark = None # when the time of the next sample starts
+
+    def started(self):
+        # a download starts
+        if not self._active:
+            self._mark = time.time()
+            self._bytes = 0
+        self._active += 1
+
+    def finished(self, nbytes=0):
+        # a download started ends, having received nbytes
+        self._active -= 1
+        self._bytes += nbytes
+        if self._bytes >= self.MIN_BYTES:
+            now = time.time()
+            self.sample(self._bytes, now - self._mark)
+            self._bytes = 0
+            self._mark = now
+
+    def sample(self, nbytes, duration):
+        if nbytes < self.MIN_BYTES:
+            return
+        duration = max(duration, self.MIN_DURATION)
+        bps = 8 * nbytes / duration
+        self._fast.sample(duration, bps)
+        self._slow.sample(duration, bps)
+        self._n_samples += 1
+
+    def estimate(self):
+        # return the estimated bits per second, or None
+        if not self._n_samples:
+            return None
+        return min(self._fast.get(), self._slow.get())
+
+
+class ABRController(object):
+    # choose the variant to fetch from the throughput and the buffer level
+
+    UP_SAFETY = 0.7 # switch up if the variant uses less of the throughput
+    DOWN_SAFETY = 0.9 # switch down if the current uses more of it
+    LOW_BUFFER = 6.0 # seconds, below it only switching down is allowed
+    MIN_INTERVAL = 8.0 # seconds between two switches up
+
+    def __init__(self, variants):
+        # variants are the EXT-X-STREAM-INF dicts
+        self.variants = sorted(variants, key=lambda x: int(x['BANDWIDTH']))
+        self._last_switch = None
+
+    def _highest_below(self, bps):
+        best = self.variants[0]
+        for v in self.variants:
+            if int(v['BANDWIDTH']) <= bps:
+                best = v
+        return best
+
+    def choose(self, current, throughput, buffer):
+        # return the variant to fetch the next segment from
+        if throughput is None:
+            return current
+        bandwidth = int(current['BANDWIDTH'])
+        now = time.time()
+        if bandwidth > throughput * self.DOWN_SAFETY:
+            v = self._highest_below(throughput * self.DOWN_SAFETY)
+        elif buffer >= self.LOW_BUFFER and \
+                (not self._last_switch or
+                 now - self._last_switch >= self.MIN_INTERVAL):
+            v = self._highest_below(throughput * self.UP_SAFETY)
+            if int(v['BANDWIDTH']) < bandwidth:
+                v = current
+        else:
+            v = current
+        if v is not current and v['uri'] != current['uri']:
+            logging.info("Switching from %r to %r bps (throughput %d bps, "
+                         "buffer %.1fs)" % (current['BANDWIDTH'],
+                         v['BANDWIDTH'], throughput, buffer))
+            self._last_switch = now
+            return v
+        return current
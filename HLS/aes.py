@@ -0,0 +1,123 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import binascii
+import os
+import struct
+from collections import OrderedDict
+
+from twisted.internet import defer, threads
+
+try:
+    from Crypto.Cipher import AES
+except ImportError:
+    AES = None
+
+CHUNK_SIZE = 64 * 1024 # bytes decrypted at once, a multiple of 16
+MAX_KEYS = 256 # keys kept, for streams rotating them
+
+
+class DecryptError(Exception):
+    pass
+
+
+class KeyCache(object):
+    # the keys of the process, keyed by uri, so that the segments and
+    # sessions using a key share one fetch of it
+
+    def __init__(self, max_keys=MAX_KEYS):
+        self.max_keys = max_keys
+        self._keys = OrderedDict() # uri -> key, least recently used first
+        self._fetching = {} # uri -> defers waiting for the key
+
+    def get(self, uri, fetch):
+        # return a defer firing with the key of uri, calling fetch(uri)
+        # if it is neither cached nor being fetched
+        if self._keys.has_key(uri):
+            key = self._keys.pop(uri)
+            self._keys[uri] = key
+            return defer.succeed(key)
+        d = defer.Deferred()
+        if self._fetching.has_key(uri):
+            self._fetching[uri].append(d)
+            return d
+
+        def check(key):
+            if len(key) != 16:
+                raise DecryptError("Invalid key of %d bytes from %s" %
+                                   (len(key), uri))
+            return key
+        def got(key):
+            self._keys[uri] = key
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(False)
+            for w in self._fetching.pop(uri):
+                w.callback(key)
+        def failed(e):
+            for w in self._fetching.pop(uri):
+                w.errback(e)
+
+        self._fetching[uri] = [d]
+        f = fetch(uri)
+        f.addCallback(check)
+        f.addCallbacks(got, failed)
+        return d
+
+
+keys = KeyCache()
+
+
+def get_iv(iv, sequence):
+    # the IV of the EXT-X-KEY, or the media sequence number
+    if iv:
+        return binascii.unhexlify(iv[2:].zfill(32))
+    return struct.pack('>QQ', 0, sequence)
+
+
+def _decrypt_file(path, key, iv):
+    if AES is None:
+        raise DecryptError("AES-128 decryption needs PyCrypto")
+    cipher = AES.new(key, AES.MODE_CBC, iv)
+    src = open(path, 'rb')
+    dst = open(path + '.dec', 'wb')
+    try:
+        last = ''
+        while True:
+            data = src.read(CHUNK_SIZE)
+            if not data:
+                break
+            if len(data) % 16:
+                raise DecryptError("%s is not a multiple of 16 bytes" % path)
+            dst.write(last)
+            last = cipher.decrypt(data)
+        # remove the PKCS7 padding
+        pad = last and ord(last[-1])
+        if not 1 <= pad <= 16:
+            raise DecryptError("Invalid padding of %s" % path)
+        dst.write(last[:-pad])
+    finally:
+        src.close()
+        dst.close()
+    os.rename(path + '.dec', path)
+
+
+def decrypt(path, key, iv):
+    # decrypt the AES-128 file in place, in a thread of the reactor pool,
+    # return a defer
+    d = threads.deferToThread(_decrypt_file, path, key, iv)
+    def failed(e):
+        if os.path.exists(path + '.dec'):
+            os.remove(path + '.dec')
+        return e
+    d.addErrback(failed)
+    return d
@@ -0,0 +1,254 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import cookielib
+import json
+import logging
+import os, os.path
+
+from twisted.internet import defer
+
+import HLS
+from HLS.hedge import HedgedRequest
+from HLS.httpclient import HTTPClient
+from HLS.m3u8 import M3U8
+
+
+class ArchiveError(Exception):
+    pass
+
+
+class _PositionalFile(object):
+    # write at an offset of a file descriptor, downloads write one chunk
+    # at a time from the reactor thread so they don't interleave
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        os.lseek(self.fd, self.offset, os.SEEK_SET)
+        while data:
+            n = os.write(self.fd, data)
+            self.offset += n
+            data = data[n:]
+
+
+class HLSArchiver(object):
+    # download all the segments of an on-demand playlist, in parallel,
+    # into one file: the segment sizes are fetched first, so that each
+    # segment is written at its offset as it is received. The progress is
+    # saved next to the output, to resume an interrupted download: a line
+    # of the segments and their sizes, then a line per segment written.
+    # The requests are retried and hedged, see hedge.HedgedRequest.
+
+    DEADLINE = 10.0 # seconds before a slow request is hedged
+
+    def __init__(self, url, output, options=None):
+        self.url = url
+        self.output = output
+        self.state_path = output + '.state'
+        if options:
+            self.referer = options.referer
+            self.bitrate = options.bitrate
+            self.n_parallel = options.parallel
+            self.max_connections = options.connections
+        else:
+            self.referer = None
+            self.bitrate = 200000
+            self.n_parallel = 3
+            self.max_connections = None
+        self._cookies = cookielib.CookieJar()
+        # each parallel request needs its own connection
+        self._client = HTTPClient(self._cookies,
+                                  max(self.max_connections or 0,
+                                      self.n_parallel))
+        self._slots = defer.DeferredSemaphore(self.n_parallel)
+
+        self._segments = None # [(url, size)] of the playlist
+        self._ranges = None # the byte range of each segment, or None
+        self._done = set() # the indexes of the segments written
+        self._fd = None
+        self._state = None # the state file the segments written are appended to
+
+    def _headers(self):
+        headers = {}
+        if self.referer:
+            headers['Referer'] = self.referer
+        return headers
+
+    def _load_playlist(self, url):
+        d = self._client.get_page(url.encode('utf-8'), self._headers())
+        d.addCallback(self._got_playlist_content, M3U8(url))
+        return d
+
+    def _got_playlist_content(self, content, pl):
+        pl.update(content)
+        if pl.has_programs():
+            (program_url, _) = pl.get_program_playlist(1, self.bitrate)
+            return self._load_playlist(HLS.make_url(pl.url, program_url))
+        if not pl.endlist():
+            raise ArchiveError("%s is not an on-demand playlist" % pl.url)
+        return pl
+
+    def _load_state(self, urls):
+        # return the saved sizes, None for the unknown ones, if the state
+        # is of the same segments
+        if not os.path.exists(self.state_path):
+            return None
+        f = open(self.state_path)
+        try:
+            try:
+                state = json.loads(f.readline())
+            except ValueError:
+                return None
+            if [u for (u, _) in state['segments']] != urls:
+                logging.info("Playlist changed, not resuming")
+                return None
+            if os.path.exists(self.output):
+                # the last line may have been cut by the interruption
+                self._done = set(int(l) for l in f if l.endswith('\n'))
+        finally:
+            f.close()
+        return [size for (_, size) in state['segments']]
+
+    def _save_state(self):
+        # write the segments and the ones written, the next ones written
+        # are appended by _segment_done
+        f = open(self.state_path + '.tmp', 'w')
+        try:
+            f.write(json.dumps(dict(segments=self._segments)) + '\n')
+            for i in sorted(self._done):
+                f.write('%d\n' % i)
+        finally:
+            f.close()
+        os.rename(self.state_path + '.tmp', self.state_path)
+
+    def _segment_done(self, i):
+        # append to the state, rewriting it would be quadratic
+        self._done.add(i)
+        self._state.write('%d\n' % i)
+        self._state.flush()
+
+    def _hedged(self, attempt, url):
+        # return a defer firing with the result of attempt(url, n, sent),
+        # retried and hedged
+        d = HedgedRequest(attempt, [url], self.DEADLINE).start()
+        d.addCallback(lambda x: x[1])
+        return d
+
+    def _get_length(self, url):
+        def attempt(url, n, sent):
+            return self._slots.run(self._client.get_length, url,
+                                   self._headers(), sent)
+        def check(length):
+            if length is None:
+                raise ArchiveError("No Content-Length for %s" % url)
+            return length
+        d = self._hedged(attempt, url)
+        d.addCallback(check)
+        return d
+
+    def _download(self, i, offset):
+        (url, size) = self._segments[i]
+        def attempt(url, n, sent):
+            f = _PositionalFile(self._fd, offset)
+            d = self._slots.run(self._client.download, url, f,
+                                self._headers(), self._ranges[i], None, sent)
+            d.addCallback(check)
+            return d
+        def check(received):
+            # retried if short
+            if received != size:
+                raise ArchiveError("Received %d bytes of %d for %s" %
+                                   (received, size, url))
+            return received
+        def done(_):
+            self._segment_done(i)
+            logging.info("Archived %d/%d segments" %
+                         (len(self._done), len(self._segments)))
+        d = self._hedged(attempt, url)
+        d.addCallback(done)
+        return d
+
+    def _got_playlist(self, pl):
+        files = list(pl.iter_files())
+        if [f for f in files if f.key]:
+            # the decrypted sizes are not known before the downloads
+            raise ArchiveError("%s is encrypted, it can't be archived" % pl.url)
+        urls = [HLS.make_url(pl.url, f.file).encode('utf-8') for f in files]
+        self._ranges = [f.byterange for f in files]
+        sizes = self._load_state(urls)
+        if sizes is None:
+            self._done = set()
+            sizes = [None] * len(urls)
+        # the size of a byte range is known
+        d = defer.DeferredList([defer.succeed(s) if s is not None else
+                                r and defer.succeed(r[0]) or
+                                self._get_length(u)
+                                for (u, r, s) in zip(urls, self._ranges, sizes)],
+                               consumeErrors=True)
+        d.addCallback(self._got_lengths, urls)
+        return d
+
+    def _got_lengths(self, results, urls):
+        # save the sizes known if some failed, a next run gets the others
+        sizes = [x if success else None for (success, x) in results]
+        failures = [x for (success, x) in results if not success]
+        if failures:
+            self._segments = zip(urls, sizes)
+            self._save_state()
+            return failures[0]
+        return self._got_sizes(sizes, urls)
+
+    def _got_sizes(self, sizes, urls):
+        def close(results):
+            # once every download has stopped writing, fail with the
+            # first error if any
+            os.close(self._fd)
+            self._fd = None
+            self._state.close()
+            self._state = None
+            for (success, x) in results:
+                if not success:
+                    return x
+            return results
+        def finished(_):
+            os.remove(self.state_path)
+            logging.info("Archived %r" % self.output)
+            return self.output
+
+        self._segments = zip(urls, sizes)
+        total = sum(sizes)
+        logging.info("Archiving %d segments, %d bytes, into %r" %
+                     (len(urls), total, self.output))
+        self._fd = os.open(self.output, os.O_RDWR | os.O_CREAT, 0644)
+        # preallocate the output, a resumed one is already allocated
+        os.ftruncate(self._fd, total)
+        self._save_state()
+        self._state = open(self.state_path, 'a')
+        offset = 0
+        todo = []
+        for (i, size) in enumerate(sizes):
+            if i not in self._done:
+                todo.append(self._download(i, offset))
+            offset += size
+        d = defer.DeferredList(todo, consumeErrors=True)
+        d.addCallback(close)
+        d.addCallback(finished)
+        return d
+
+    def start(self):
+        d = self._load_playlist(self.url)
+        d.addCallback(self._got_playlist)
+        return d
@@ -0,0 +1,72 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+
+def parse_amount(value):
+    # return the (amount, wether in seconds) of a number of segments, or
+    # of seconds with an 's' suffix as in "10s", raise ValueError
+    if isinstance(value, basestring):
+        value = value.strip()
+        if value.endswith('s'):
+            amount = float(value[:-1])
+            seconds = True
+        else:
+            amount = float(value)
+            seconds = False
+    else:
+        amount = float(value)
+        seconds = False
+    if amount < 0:
+        raise ValueError("Negative buffer %r" % value)
+    return amount, seconds
+
+
+class BufferController(object):
+    # keep the media downloaded ahead of the player between watermarks:
+    # below the low one, fetch as fast as possible up to the high one,
+    # then pause until the player brings it back to the low one
+
+    def __init__(self, low=3, high=None):
+        self.low = parse_amount(low)
+        if high is None:
+            self.high = (2 * self.low[0], self.low[1])
+        else:
+            self.high = parse_amount(high)
+        self._filling = True
+
+    def _seconds(self, amount, segment_duration):
+        (value, seconds) = amount
+        if seconds:
+            return value
+        return value * segment_duration
+
+    def watermarks(self, segment_duration):
+        # return the (low, high) watermarks in seconds, segment_duration
+        # being the seconds of the segment counts
+        low = self._seconds(self.low, segment_duration)
+        high = self._seconds(self.high, segment_duration)
+        return low, max(low, high)
+
+    def delay(self, ahead, segment_duration):
+        # return the seconds to wait before the next download, ahead
+        # being the seconds of media downloaded or downloading ahead of
+        # the player
+        (low, high) = self.watermarks(segment_duration)
+        if ahead < low:
+            self._filling = True
+        if ahead >= high:
+            self._filling = False
+        if self._filling:
+            return 0
+        # the player consumes a second of media per second
+        return ahead - low
@@ -0,0 +1,281 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import bisect
+import hashlib
+import json
+import logging
+import os, os.path
+import shutil
+import tempfile
+import urlparse
+from collections import OrderedDict
+
+from twisted.internet import defer, reactor
+
+from HLS import stats
+
+
+class SegmentCache(object):
+    # the cached segments, sequence n -> path, ordered by sequence
+
+    def __init__(self):
+        self._sequences = [] # sorted
+        self._paths = {}
+        self._durations = {}
+
+    def __len__(self):
+        return len(self._sequences)
+
+    def __contains__(self, sequence):
+        return sequence in self._paths
+
+    def __getitem__(self, sequence):
+        return self._paths[sequence]
+
+    def keys(self):
+        return list(self._sequences)
+
+    def add(self, sequence, path, duration=0):
+        if sequence not in self._paths:
+            if not self._sequences or sequence > self._sequences[-1]:
+                self._sequences.append(sequence)
+            else:
+                bisect.insort(self._sequences, sequence)
+        self._paths[sequence] = path
+        self._durations[sequence] = duration
+
+    def find(self, sequence):
+        # return the first (sequence, path) at or after sequence, or None
+        i = bisect.bisect_left(self._sequences, sequence)
+        if i == len(self._sequences):
+            return None
+        sequence = self._sequences[i]
+        return sequence, self._paths[sequence]
+
+    def duration(self, sequence):
+        return self._durations[sequence]
+
+    def duration_from(self, sequence):
+        # return the duration of the cached segments from sequence
+        i = bisect.bisect_left(self._sequences, sequence)
+        return sum(self._durations[s] for s in self._sequences[i:])
+
+    def pop(self, sequence):
+        # remove and return the path of sequence
+        self._sequences.remove(sequence)
+        del self._durations[sequence]
+        return self._paths.pop(sequence)
+
+    def pop_until(self, sequence):
+        # remove and return the (sequence, path) up to sequence included
+        i = bisect.bisect_right(self._sequences, sequence)
+        removed = self._sequences[:i]
+        del self._sequences[:i]
+        for s in removed:
+            del self._durations[s]
+        return [(s, self._paths.pop(s)) for s in removed]
+
+
+class _StoreEntry(object):
+
+    __slots__ = ('url', 'path', 'refs', 'waiters', 'size', 'persistent',
+                 'download')
+
+    def __init__(self, url, path, persistent=False):
+        self.url = url
+        self.path = path
+        self.refs = 1
+        self.waiters = [] # defers waiting for the download, None once done
+        self.size = 0
+        self.persistent = persistent # kept unused, and across runs
+        self.download = None # the defer of the download
+
+
+class SegmentStore(object):
+    # the segment files of the process, keyed by url and reference
+    # counted, so that sessions fetching the same url share one download
+    # and one file.
+    # Unused persistent segments are kept, least recently used first,
+    # within max_bytes, and listed in an index to be reused by later runs
+    # on the same path.
+
+    INDEX = 'index.json'
+    INDEX_DELAY = 5.0 # seconds the changes gather before the index is written
+
+    def __init__(self, path=None, max_bytes=None):
+        self.path = path # a temporary directory is created if None
+        self._temporary = False # wether path is the temporary directory
+        self.max_bytes = max_bytes
+        self.size = 0 # bytes of the stored files
+        self._entries = {} # url -> _StoreEntry
+        self._paths = {} # path -> _StoreEntry
+        self._unused = OrderedDict() # url -> unused persistent _StoreEntry
+        self.stats = None # registered on the first fetch
+        self._index_call = None # the delayed write of the changed index
+        if path:
+            self._load_index()
+            reactor.addSystemEventTrigger('before', 'shutdown', self._save_index)
+
+    def _path_for(self, url):
+        if not self.path:
+            self.path = tempfile.mkdtemp()
+            self._temporary = True
+            reactor.addSystemEventTrigger('before', 'shutdown',
+                                          shutil.rmtree, self.path, True)
+        name = urlparse.urlparse(url).path.split('/')[-1]
+        return os.path.join(self.path,
+                            hashlib.md5(url).hexdigest()[:8] + '-' + name)
+
+    def _load_index(self):
+        index = os.path.join(self.path, self.INDEX)
+        if not os.path.exists(index):
+            return
+        try:
+            entries = json.load(open(index))
+        except ValueError, e:
+            logging.error("Ignoring invalid index %r: %r" % (index, e))
+            return
+        for (url, name, size) in entries:
+            path = os.path.join(self.path, name)
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                continue
+            e = _StoreEntry(url.encode('utf-8'), path, True)
+            e.refs = 0
+            e.waiters = None
+            e.size = size
+            self.size += size
+            self._add(e)
+            self._unused[e.url] = e
+        logging.debug("Loaded %d segments from %r" % (len(self._unused), index))
+        self._evict()
+
+    def _index_changed(self):
+        # write the index a little later, with the changes made meanwhile,
+        # or at shutdown
+        if not self.path or self._temporary or self._index_call:
+            return
+        self._index_call = reactor.callLater(self.INDEX_DELAY, self._save_index)
+
+    def _save_index(self):
+        call, self._index_call = self._index_call, None
+        if call is None:
+            # unchanged
+            return
+        if call.active():
+            call.cancel()
+        persistent = [e for e in self._entries.values()
+                      if e.persistent and e.waiters is None and e.refs]
+        entries = [(e.url, os.path.basename(e.path), e.size)
+                   for e in self._unused.values() + persistent]
+        index = os.path.join(self.path, self.INDEX)
+        f = open(index + '.tmp', 'w')
+        try:
+            json.dump(entries, f)
+        finally:
+            f.close()
+        os.rename(index + '.tmp', index)
+
+    def fetch(self, url, download, persistent=False):
+        # return a defer firing with the path of url, calling
+        # download(url, path) if it is neither stored nor downloading,
+        # every fetch must be matched by a release of the path, or by
+        # cancelling the defer before it fires
+        if not self.stats:
+            self.stats = stats.registry.session('store')
+        e = self._entries.get(url)
+        if e:
+            self.stats.incr('store_hits')
+            self._unused.pop(url, None)
+            e.refs += 1
+            if e.waiters is None:
+                return defer.succeed(e.path)
+            return self._wait(e)
+
+        def done(x):
+            waiters, e.waiters = e.waiters, None
+            e.size = os.path.getsize(e.path)
+            self.size += e.size
+            if e.refs == 0:
+                self._unuse(e)
+            elif e.persistent:
+                self._index_changed()
+            self._evict()
+            for w in waiters:
+                w.callback(e.path)
+        def failed(failure):
+            waiters = e.waiters
+            self._remove(e)
+            for w in waiters:
+                w.errback(failure)
+
+        self.stats.incr('store_misses')
+        path = self._path_for(url)
+        e = _StoreEntry(url, path, persistent and not self._temporary)
+        self._add(e)
+        d = self._wait(e)
+        e.download = download(url, e.path)
+        e.download.addCallbacks(done, failed)
+        return d
+
+    def _wait(self, e):
+        # return a defer waiting for the download of e, cancelling it
+        # cancels the download once nobody else waits for it
+        def cancel(d):
+            e.waiters.remove(d)
+            e.refs -= 1
+            if e.refs == 0:
+                e.download.cancel()
+        d = defer.Deferred(cancel)
+        e.waiters.append(d)
+        return d
+
+    def __contains__(self, url):
+        return self._entries.has_key(url)
+
+    def release(self, path):
+        e = self._paths.get(path)
+        if not e:
+            return
+        e.refs -= 1
+        if e.refs == 0 and e.waiters is None:
+            self._unuse(e)
+
+    def _add(self, e):
+        self._entries[e.url] = self._paths[e.path] = e
+
+    def _unuse(self, e):
+        if e.persistent:
+            self._unused[e.url] = e
+            self._evict()
+            self._index_changed()
+        else:
+            self._remove(e)
+
+    def _evict(self):
+        # remove the least recently used segments beyond max_bytes
+        while self.max_bytes and self.size > self.max_bytes and self._unused:
+            (_, e) = self._unused.popitem(last=False)
+            self._remove(e)
+
+    def _remove(self, e):
+        if self.stats:
+            self.stats.incr('store_evictions')
+        self.size -= e.size
+        if e.persistent:
+            self._index_changed()
+        del self._entries[e.url]
+        del self._paths[e.path]
+        if os.path.exists(e.path):
+            logging.debug("Removing %r" % e.path)
+            os.remove(e.path)
@@ -11,23 +11,104 @@
 # warranty of merchantability or fitness for a particular purpose.
 # See "LICENSE" in the source distribution for more information.
 
-from itertools import ifilter
+import cookielib
 import logging
 import os, os.path
-import tempfile
-import urlparse
+import random
+import time
 
-from twisted.python import log
-from twisted.web import client
-from twisted.internet import defer, reactor, task
-from twisted.internet.task import deferLater
+from twisted.python import failure, log
+from twisted.internet import defer, reactor
 
 import HLS
-from HLS.m3u8 import M3U8
+from HLS import aes, scheduler, stats
+from HLS.abr import ABRController, ThroughputEstimator
+from HLS.buffer import BufferController
+from HLS.cache import SegmentCache, SegmentStore
+from HLS.hedge import HedgedRequest
+from HLS.httpclient import HTTPClient
+from HLS.m3u8 import M3U8, parse_date
+from HLS.notify import SequenceNotifier
+
+class _SplitFile(object):
+    # write a body to the files of its consecutive parts, a part being
+    # (length, file), the last length may be None and a None file
+    # discards its part
+
+    def __init__(self, parts):
+        self.parts = parts
+        self._i = 0
+        self._written = 0 # bytes of the current part
+
+    def write(self, data):
+        while data:
+            (length, file) = self.parts[self._i]
+            n = len(data)
+            if length is not None:
+                n = min(n, length - self._written)
+            if file:
+                file.write(data[:n])
+            self._written += n
+            data = data[n:]
+            if self._written == length:
+                if self._i + 1 == len(self.parts):
+                    return
+                self._i += 1
+                self._written = 0
+
+
+class PlaylistReloader(object):
+    # reload a live media playlist on the cadence of its target duration,
+    # one reload at a time, the delays counting from the reload starts
+    # so that the request latency doesn't add up
+
+    JITTER = 0.1 # fraction of the delay randomly added or removed
+
+    def __init__(self, pl, reload):
+        self.pl = pl
+        self._reload = reload # called with pl, returns a defer
+        self._call = None
+        self._reloading = None
+        self._running = False
+        self._started = None # when the last reload started
+
+    def start(self):
+        self._running = True
+        self._started = None
+        self._schedule()
+
+    def stop(self):
+        self._running = False
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        if not self._running or self.pl.endlist() or self._reloading:
+            return
+        delay = self.pl.reload_delay()
+        delay *= 1 + random.uniform(-self.JITTER, self.JITTER)
+        if self._started is not None:
+            delay = max(0, delay - (reactor.seconds() - self._started))
+        self._call = reactor.callLater(delay, self._run)
+
+    def _run(self):
+        def done(x):
+            self._reloading = None
+            self._schedule()
+        self._call = None
+        self._started = reactor.seconds()
+        self._reloading = self._reload(self.pl)
+        self._reloading.addErrback(log.err)
+        self._reloading.addBoth(done)
+
 
 class HLSFetcher(object):
 
-    def __init__(self, url, options=None, program=1):
+    DEADLINE = 1.5 # of the segment duration, before hedging its request
+    MIN_DEADLINE = 1.0 # seconds
+
+    def __init__(self, url, options=None, program=1, store=None):
         self.url = url
         self.program = program
         if options:
@@ -35,204 +116,713 @@ class HLSFetcher(object):
             self.referer = options.referer
             self.bitrate = options.bitrate
             self.n_segments_keep = options.keep
-            self.nbuffer = options.buffer
+            self.buffer = BufferController(options.buffer, options.max_buffer)
+            self.n_parallel = options.parallel
+            self.max_connections = options.connections
+            self.abr = options.abr
+            self.fast_start = options.fast_start
+            self.start_position = options.start
+            self.discard = options.keep == 0
+            self.cache_size = options.cache_size * 1024 * 1024
         else:
             self.path = None
             self.referer = None
             self.bitrate = 200000
             self.n_segments_keep = 3
-            self.nbuffer = 3
-        if not self.path:
-            self.path = tempfile.mkdtemp()
+            self.buffer = BufferController()
+            self.n_parallel = 3
+            self.max_connections = None
+            self.abr = False
+            self.fast_start = False
+            self.start_position = None
+            self.discard = False
+            self.cache_size = None
+        if not store:
+            store = SegmentStore(self.path, self.cache_size)
+        self._store = store # the segment files, maybe shared with other fetchers
+        self.path = store.path
 
         self._program_playlist = None
+        self._media_playlist = None # the media playlist to load and reload
         self._file_playlist = None
-        self._cookies = {}
-        self._cached_files = {} # sequence n -> path
+        self._variant = None # the EXT-X-STREAM-INF dict being fetched
+        self._target_variant = None # to switch to once started fast
+        self._abr = None
+        self.start_time = None
+        self.startup_time = None # seconds from start to the first segment
+        self._throughput = ThroughputEstimator()
+        self.bytes_received = 0 # of the segments
+        self.stats = stats.registry.session(url)
+        self._cookies = cookielib.CookieJar()
+        self._client = HTTPClient(self._cookies, self.max_connections)
+        self._throttle = scheduler.bandwidth.session(self.buffered, self.stats)
+        self._cached_files = SegmentCache() # sequence n -> path
 
-        self._files = None # the iter of the playlist files download
-        self._next_download = None # the delayed download defer, if any
-        self._file_playlisted = None # the defer to wait until new files are added to playlist
+        self.segment_listed = SequenceNotifier() # fired with the media playlist
+        self.segment_downloaded = SequenceNotifier() # fired with (path, url, f)
+        self._switching = False # wether the variant playlist is being loaded
+        self._file_listed = None # the defer waiting for the next file to be listed
+        self._file_allowed = None # the defer waiting for the rates to allow a download
+        self._downloading = {} # sequence n -> in-flight download defer
+        self._download_order = [] # sequences not yet handed over, in playlist order
+        self._downloaded = {} # sequence n -> result, completed out of order
+        self._partials = {} # sequence n -> (path, readers) of segments being received
+        self._next_sequence = None # the next sequence to download
+        self._player_sequence = None # the last sequence asked by get_file
+        self._player_time = None # when the player got its last segment
+        self._fetched_duration = 0 # seconds of media handed over
 
-        self._pl_task = None
-        self._seg_task = None
+        self._pl_task = None # the PlaylistReloader of the media playlist
+        self._seg_task = None # the delayed call filling the download window
+        self._stopped = False # no download nor reload is started once stopped
 
-    def _get_page(self, url):
+    def _get_page(self, url, file=None, byterange=None, validators=None,
+                  sent=None, progress=None):
         def got_page(content):
-            logging.debug("Cookies: %r" % self._cookies)
+            logging.debug("Cookies: %r" % list(self._cookies))
             return content
         def got_page_error(e, url):
+            if e.check(defer.CancelledError):
+                return e
             logging.error(url)
             log.err(e)
             return e
 
         url = url.encode("utf-8")
         if 'HLS_RESET_COOKIES' in os.environ.keys():
-            self._cookies = {}
+            self._cookies.clear()
         headers = {}
         if self.referer:
             headers['Referer'] = self.referer
-        d = client.getPage(url, cookies=self._cookies, headers=headers)
+        if file:
+            d = self._client.download(url, file, headers, byterange,
+                                      self._throttle, sent, progress)
+        elif validators is not None:
+            # a conditional reload, validators maps the urls to the
+            # (etag, last modified) of their last response
+            d = self._client.get_playlist(url, headers, validators.get(url),
+                                          sent)
+            d.addCallback(self._got_playlist_page, url, validators)
+        else:
+            d = self._client.get_page(url, headers, sent)
         d.addCallback(got_page)
         d.addErrback(got_page_error, url)
         return d
 
-    def _download_page(self, url, path):
+    def _got_playlist_page(self, x, url, validators):
+        # return the content, or None if not modified
+        (content, v) = x
+        if v:
+            validators[url] = v
+        if content is None:
+            self.stats.incr('playlist_not_modified')
+        else:
+            self.stats.incr('playlist_bytes', len(content))
+        return content
+
+    def _download_page(self, url, file, byterange=None, sent=None,
+                       progress=None):
         # client.downloadPage does not support cookies!
         def _check(x):
-            logging.debug("Received segment of %r bytes." % len(x))
+            logging.debug("Received segment of %r bytes." % x)
+            if byterange and x != byterange[0]:
+                raise IOError("Received %d bytes of %d from %s" %
+                              (x, byterange[0], url))
             return x
 
-        d = self._get_page(url)
+        d = self._get_page(url, file, byterange, sent=sent, progress=progress)
         d.addCallback(_check)
         return d
 
-        return d
+    def _segment_key(self, url, f):
+        # the store key of a segment, the byte ranges of a file differ
+        if f.byterange:
+            return '%s#%d-%d' % (url, f.byterange[1], f.byterange[0])
+        return url
+
+    def _adjacent(self, f, n):
+        # wether segment n follows f in the same file
+        return n is not None and f.byterange and n.byterange and \
+            n.file == f.file and n.byterange[1] == sum(f.byterange)
+
+    def _download_segments(self, group):
+        # download the segments with one request, several segments being
+        # adjacent byte ranges of the same file, return their defers
+        url = HLS.make_url(self._file_playlist.url, group[0].file)
+        parts = {} # sequence n -> (path, defer) of the segments to download
+        cancelled = set()
+        request = [] # the defer of the request of the parts
+        def cancel(f):
+            # stop the request once none of its parts is wanted
+            cancelled.add(f.sequence)
+            if len(cancelled) == len(parts) and request:
+                request[0].cancel()
+        def download(f, path):
+            d = defer.Deferred(lambda _: cancel(f))
+            parts[f.sequence] = (path, d)
+            return d
 
-    def _download_segment(self, f):
-        url = HLS.make_url(self._file_playlist.url, f['file'])
-        name = urlparse.urlparse(f['file']).path.split('/')[-1]
-        path = os.path.join(self.path, name)
-        d = self._download_page(url, path)
-        if self.n_segments_keep != 0:
-            file = open(path, 'w')
-            d.addCallback(lambda x: file.write(x))
-            d.addBoth(lambda _: file.close())
-            d.addCallback(lambda _: path)
-            d.addErrback(self._got_file_failed)
-            d.addCallback(self._got_file, url, f)
+        if self.discard:
+            ds = [download(f, None) for f in group]
         else:
-            d.addCallback(lambda _: (None, path, f))
+            # on-demand segments may be kept for later runs, unless forbidden
+            persistent = self._file_playlist.endlist() and \
+                (group[0].allow_cache or '').strip().upper() != 'NO'
+            ds = [self._store.fetch(self._segment_key(url, f),
+                                    lambda key, path, f=f: download(f, path),
+                                    persistent)
+                  for f in group]
+        if parts:
+            request.append(self._download_parts(url, group, parts))
+        for (d, f) in zip(ds, group):
+            d.addCallback(lambda path, f=f: (path, url, f))
+        return ds
+
+    def _decrypt(self, path, f, key_url):
+        # decrypt the segment file in place, off the reactor thread
+        def got_key(key):
+            start = time.time()
+            d = aes.decrypt(path, key, aes.get_iv(f.key.get('IV'), f.sequence))
+            d.addCallback(measure, start)
+            return d
+        def measure(x, start):
+            self.stats.observe('decrypt_time', time.time() - start)
+            return path
+
+        if f.key.get('METHOD') != 'AES-128':
+            return defer.fail(aes.DecryptError("Unsupported encryption %r" %
+                                               f.key.get('METHOD')))
+        d = aes.keys.get(key_url, self._get_page)
+        d.addCallback(got_key)
+        return d
+
+    def _backup_urls(self, url, f):
+        # the url of the segment on the backup streams of the variant
+        if not self._variant:
+            return []
+        return [HLS.make_url(HLS.make_url(self.url, b), f.file)
+                for b in self._variant.get('backups', [])]
+
+    def _download_parts(self, url, group, parts):
+        segments = dict((f.sequence, f) for f in group)
+        key_urls = dict((f.sequence, HLS.make_url(self._file_playlist.url,
+                                                  f.key.get('URI', '')))
+                        for f in group if f.key)
+        lengths = [f.byterange and f.byterange[0] for f in group]
+        byterange = None
+        if group[0].byterange:
+            byterange = (sum(lengths), group[0].byterange[1])
+
+        def _attempt(url, n, sent):
+            # each request writes its own files, the first to complete
+            # is renamed
+            files = {} # sequence n -> the open file
+            for (sequence, (path, _)) in parts.items():
+                if path:
+                    # unbuffered, the player may read it as it grows
+                    files[sequence] = open('%s.%d' % (path, n), 'wb', 0)
+            def _progress(received, length):
+                # the parts are received in order, tell the readers of the
+                # one being written
+                for (l, f) in zip(lengths, group):
+                    if l is None or received <= l:
+                        break
+                    received -= l
+                if files.has_key(f.sequence) and not f.key and \
+                        not parts[f.sequence][1].called:
+                    # encrypted ones can't be read before decryption
+                    p = self._partials.setdefault(f.sequence,
+                                                  (files[f.sequence].name, []))
+                    for reader in p[1]:
+                        reader()
+            def _done(x):
+                for file in files.values():
+                    file.close()
+                if isinstance(x, failure.Failure):
+                    self._throughput.finished()
+                else:
+                    self._throughput.finished(x)
+                return x
+            def _failed(e):
+                for file in files.values():
+                    if os.path.exists(file.name):
+                        os.remove(file.name)
+                return e
+
+            file = _SplitFile([(l, files.get(f.sequence))
+                               for (l, f) in zip(lengths, group)])
+            self._throughput.started()
+            d = self._download_page(url, file, byterange, sent, _progress)
+            d.addCallback(self._measure, time.time(), len(group))
+            d.addBoth(_done)
+            d.addErrback(_failed)
+            return d
+
+        def _downloaded(x):
+            (n, _) = x
+            for f in group:
+                self._partials.pop(f.sequence, None)
+            for sequence in sorted(parts.keys()):
+                (path, d) = parts[sequence]
+                if d.called:
+                    # cancelled
+                    if path:
+                        _remove(None, '%s.%d' % (path, n))
+                    continue
+                if path:
+                    os.rename('%s.%d' % (path, n), path)
+                if path and key_urls.has_key(sequence):
+                    dd = self._decrypt(path, segments[sequence], key_urls[sequence])
+                    dd.addErrback(_remove, path)
+                    dd.addBoth(_decrypted, d, path)
+                else:
+                    d.callback(path)
+        def _decrypted(x, d, path):
+            if d.called:
+                # cancelled while decrypting
+                _remove(None, path)
+            elif isinstance(x, failure.Failure):
+                d.errback(x)
+            else:
+                d.callback(x)
+        def _remove(e, path):
+            if os.path.exists(path):
+                os.remove(path)
+            return e
+        def _failed(e):
+            for f in group:
+                self._partials.pop(f.sequence, None)
+            for sequence in sorted(parts.keys()):
+                if not parts[sequence][1].called:
+                    parts[sequence][1].errback(e)
+
+        if len(group) > 1:
+            logging.debug("Downloading segments %d-%d with one request" %
+                          (group[0].sequence, group[-1].sequence))
+        # hedge the requests slower than the media they fetch
+        deadline = max(self.DEADLINE * sum(f.duration for f in group),
+                       self.MIN_DEADLINE)
+        r = HedgedRequest(_attempt, [url] + self._backup_urls(url, group[0]),
+                          deadline, self.stats, self._throttle.throttled)
+        d = r.start()
+        d.addCallbacks(_downloaded, _failed)
         return d
 
-    def delete_cache(self, f):
-        keys = self._cached_files.keys()
-        for i in ifilter(f, keys):
-            filename = self._cached_files[i]
-            logging.debug("Removing %r" % filename)
-            os.remove(filename)
-            del self._cached_files[i]
-        self._cached_files
+    def _measure(self, nbytes, start, segments=1):
+        duration = time.time() - start
+        self.bytes_received += nbytes
+        self.stats.incr('segments', segments)
+        self.stats.incr('bytes', nbytes)
+        self.stats.observe('segment_time', duration)
+        if duration > 0:
+            self.stats.observe('segment_bitrate', 8 * nbytes / duration,
+                               stats.BITRATE_BUCKETS)
+        return nbytes
+
+    def get_partial(self, sequence, reader):
+        # return the path of the file a segment is being received into, or
+        # None if it is not, so the player can read it before the end.
+        # reader is called as the file grows, until the segment is handed
+        # over by get_segment, the file is then renamed or replaced.
+        p = self._partials.get(sequence)
+        if not p:
+            return None
+        p[1].append(reader)
+        return p[0]
 
-    def _got_file_failed(self, e):
-        if self._new_filed:
-            self._new_filed.errback(e)
-            self._new_filed = None
+    def delete_cache(self, sequence):
+        # remove the cached files up to sequence included
+        for (_, filename) in self._cached_files.pop_until(sequence):
+            self.stats.incr('evictions')
+            self._store.release(filename)
+
+    def _got_file_failed(self, e, f):
+        self.stats.incr('segment_errors')
+        self.segment_downloaded.fail(e, f.sequence)
 
     def _got_file(self, path, url, f):
-        logging.debug("Saved " + url + " in " + path)
-        self._cached_files[f['sequence']] = path
+        logging.debug("Saved %r in %r" % (url, path))
+        if self.startup_time is None:
+            self.startup_time = time.time() - self.start_time
+            self.stats.set('startup_time', self.startup_time)
+            self.stats.observe('startup_time', self.startup_time)
+            logging.info("Got the first segment of %s after %.3fs" %
+                         (self.url, self.startup_time))
+        self._cached_files.add(f.sequence, path, f.duration)
+        self._fetched_duration += f.duration
         if self.n_segments_keep != -1:
-            self.delete_cache(lambda x: x <= f['sequence'] - self.n_segments_keep)
-        if self._new_filed:
-            self._new_filed.callback((path, url, f))
-            self._new_filed = None
+            self.delete_cache(f.sequence - self.n_segments_keep)
+        self.stats.set('buffer', self.buffered())
+        self.segment_downloaded.notify(f.sequence, (path, url, f))
         return (path, url, f)
 
+    def _segment_downloaded(self, x, f, d):
+        # downloads complete out of order, hand them over in sequence order
+        if self._downloading.get(f.sequence) is not d:
+            # abandoned by a seek
+            return
+        del self._downloading[f.sequence]
+        if self._stopped:
+            return
+        if isinstance(x, failure.Failure):
+            self._got_file_failed(x, f)
+            x = None
+        self._downloaded[f.sequence] = x
+        self._hand_over()
+        self._schedule_next_file(0)
+
+    def _hand_over(self):
+        while self._download_order and self._download_order[0] in self._downloaded:
+            r = self._downloaded.pop(self._download_order.pop(0))
+            if r:
+                self._got_file(*r)
+
     def _get_next_file(self):
-        next = self._files.next()
-        if next:
-            d = self._download_segment(next)
-            return d
-        elif not self._file_playlist.endlist():
-            self._seg_task.stop()
-            self._file_playlisted = defer.Deferred()
-            self._file_playlisted.addCallback(lambda x: self._get_next_file())
-            self._file_playlisted.addCallback(self._next_file_delay)
-            self._file_playlisted.addCallback(self._seg_task.start)
-            return self._file_playlisted
+        # fill the download window with the next files of the playlist
+        self._seg_task = None
+        if self._stopped:
+            return
+        n_parallel = self.n_parallel
+        if self.fast_start and self.startup_time is None:
+            # the first segment alone, not to share the bandwidth
+            n_parallel = 1
+        while self._file_playlist and not self._switching and \
+                len(self._downloading) < n_parallel:
+            delay = self.buffer.delay(self._ahead(),
+                                      self._file_playlist.target_duration)
+            if delay > 0:
+                self._schedule_next_file(delay)
+                return
+            if self._check_variant():
+                return
+            if self._file_allowed or self._wait_allowed():
+                return
+            # skip the files that went out of the live window
+            pl = self._file_playlist
+            f = pl.get_file(max(self._next_sequence, pl.first_sequence()))
+            if not f:
+                self._wait_listed()
+                return
+            # merge the next byte ranges of the same file in the window,
+            # unless they are already stored
+            group = [f]
+            url = HLS.make_url(self._file_playlist.url, f.file)
+            while self._segment_key(url, f) not in self._store and \
+                    len(self._downloading) + len(group) < self.n_parallel:
+                n = self._file_playlist.get_file(f.sequence + 1)
+                if not self._adjacent(f, n) or \
+                        self._segment_key(url, n) in self._store:
+                    break
+                group.append(n)
+                f = n
+            self._next_sequence = f.sequence + 1
+            for (f, d) in zip(group, self._download_segments(group)):
+                self._download_order.append(f.sequence)
+                self._downloading[f.sequence] = d
+                d.addBoth(self._segment_downloaded, f, d)
+
+    def _wait_allowed(self):
+        # get the next files once the rates allow, the least buffered
+        # sessions first, return wether waiting
+        def allowed(_):
+            self._file_allowed = None
+            self._get_next_file()
+        d = self._throttle.wait()
+        if d.called:
+            return False
+        self._file_allowed = d
+        d.addCallback(allowed)
+        d.addErrback(lambda e: e.trap(defer.CancelledError))
+        return True
+
+    def _wait_listed(self):
+        # get the next files once they are listed
+        def listed(_):
+            self._file_listed = None
+            self._get_next_file()
+        if self._file_playlist.endlist() or self._file_listed:
+            return
+        self._file_listed = self.segment_listed.wait(self._next_sequence)
+        self._file_listed.addCallback(listed)
+        # cancelled by a seek or stop
+        self._file_listed.addErrback(lambda e: e.trap(defer.CancelledError))
+
+    def buffered(self):
+        # return the seconds of media downloaded ahead of the player
+        if self._player_sequence is None:
+            # none asked yet, or none at all as with -D: the cache may
+            # be trimmed or kept whole, so play in real time from the
+            # first segment instead
+            if self.startup_time is None:
+                return 0
+            played = time.time() - self.start_time - self.startup_time
+            return max(0, self._fetched_duration - played)
+        buffered = self._cached_files.duration_from(self._player_sequence)
+        if self._player_time is not None and \
+                self._player_sequence in self._cached_files:
+            # less the part of the segment already played
+            buffered -= min(time.time() - self._player_time,
+                            self._cached_files.duration(self._player_sequence))
+        return buffered
+
+    def _ahead(self):
+        # return the seconds of media downloaded and downloading ahead
+        # of the player
+        pl = self._file_playlist
+        ahead = self.buffered()
+        for s in self._download_order:
+            f = pl.get_file(s)
+            if f and (self._player_sequence is None or s >= self._player_sequence):
+                ahead += f.duration
+        return ahead
+
+    def _check_variant(self):
+        # switch variant at the segment boundary if the ABR says so, or
+        # to the target bitrate once started fast,
+        # return wether the files are being reloaded
+        if self._abr:
+            v = self._abr.choose(self._variant, self._throughput.estimate(),
+                                 self.buffered())
+        elif self._target_variant and self.startup_time is not None:
+            v, self._target_variant = self._target_variant, None
+        else:
+            return False
+        if v is self._variant:
+            return False
+        logging.debug("Switching to variant %r" % v['uri'])
+        old = (self._variant, self._media_playlist)
+        def failed(e):
+            log.err(e)
+            (self._variant, self._media_playlist) = old
+            self._switching = False
+            self._get_next_file()
+
+        self._variant = v
+        self._switching = True
+        d = self._load_variant(v['uri'])
+        d.addCallbacks(lambda _: self._get_next_file(), failed)
+        return True
+
+    def _schedule_next_file(self, delay):
+        if self._seg_task and self._seg_task.active():
+            if self._seg_task.getTime() <= reactor.seconds() + delay:
+                return
+            self._seg_task.cancel()
+        self._seg_task = reactor.callLater(delay, self._get_next_file)
 
     def _handle_end(self, failure):
         failure.trap(StopIteration)
         print "End of media"
         reactor.stop()
 
-    def _next_file_delay(self, f):
-        delay = f[2]["duration"]
-        # FIXME not only the last nbuffer, but the nbuffer -1 ...
-        if self.nbuffer > 0 and not self._cached_files.has_key(f[2]['sequence'] - (self.nbuffer - 1)):
-            delay = 0
-        elif self._file_playlist.endlist():
-            delay = 1
-        return delay
-
-    def _get_files_loop(self):
-        if not self._seg_task:
-            self._seg_task = task.LoopingCall(self._get_next_file)
-        d = self._get_next_file()
-        d.addCallback(self._next_file_delay)
-        d.addCallback(self._seg_task.start)
-        return d
-
     def _playlist_updated(self, pl):
         if pl.has_programs():
             # if we got a program playlist, save it and start a program
             self._program_playlist = pl
-            (program_url, _) = pl.get_program_playlist(self.program, self.bitrate)
-            l = HLS.make_url(self.url, program_url)
-            return self._reload_playlist(M3U8(l))
+            (program_url, self._variant) = pl.get_program_playlist(self.program, self.bitrate)
+            if self.abr:
+                self._abr = ABRController(pl.get_programs())
+            if self.fast_start:
+                # start on the lowest bitrate, then ramp up to the target,
+                # or let the ABR do it
+                lowest = min(pl.get_programs(), key=lambda x: int(x['BANDWIDTH']))
+                if not self._abr:
+                    self._target_variant = self._variant
+                self._variant = lowest
+                program_url = lowest['uri']
+            return self._load_variant(program_url)
         elif pl.has_files():
+            if pl is not self._media_playlist:
+                # a late reload of the variant we switched from
+                return pl
             # we got sequence playlist, start reloading it regularly, and get files
             self._file_playlist = pl
-            if not self._files:
-                self._files = pl.iter_files()
-            if not pl.endlist():
+            self._switching = False
+            if self._next_sequence is None:
+                self._next_sequence = self._position_sequence(pl,
+                                                              self.start_position)
+            if not pl.endlist() and not self._stopped:
+                if self._pl_task and self._pl_task.pl is not pl:
+                    self._pl_task.stop()
+                    self._pl_task = None
                 if not self._pl_task:
-                    self._pl_task = task.LoopingCall(self._reload_playlist, pl)
-                    self._pl_task.start(10, False)
-            if self._file_playlisted:
-                self._file_playlisted.callback(pl)
-                self._file_playlisted = None
+                    self._pl_task = PlaylistReloader(pl, self._reload_playlist)
+                    self._pl_task.start()
+            self.segment_listed.notify(pl.last_sequence(), pl)
         else:
             raise
         return pl
 
+    def _load_variant(self, uri):
+        l = HLS.make_url(self.url, uri)
+        self._media_playlist = M3U8(l)
+        return self._reload_playlist(self._media_playlist)
+
     def _got_playlist_content(self, content, pl):
-        if not pl.update(content):
-            # if the playlist cannot be loaded, start a reload timer
-            self._pl_task.stop()
-            self._pl_task.start(pl.reload_delay(), False)
-            d = deferLater(reactor, pl.reload_delay(), self._fetch_playlist, pl)
-            d.addCallback(self._got_playlist_content, pl)
-            return d
+        if pl is not self._media_playlist and pl is not self._program_playlist:
+            return pl
+        if content is None:
+            pl.unchanged()
+        else:
+            pl.update(content)
         return pl
 
     def _fetch_playlist(self, pl):
         logging.debug('fetching %r' % pl.url)
-        d = self._get_page(pl.url)
+        urls = [pl.url]
+        if pl is self._media_playlist and self._variant:
+            urls += [HLS.make_url(self.url, b)
+                     for b in self._variant.get('backups', [])]
+        deadline = max(self.DEADLINE * (getattr(pl, 'target_duration', 0) or 0),
+                       self.MIN_DEADLINE)
+        def attempt(url, n, sent):
+            return self._get_page(url, validators=pl.validators, sent=sent)
+        r = HedgedRequest(attempt, urls, deadline, self.stats)
+        d = r.start()
+        d.addCallback(lambda x: x[1])
         return d
 
     def _reload_playlist(self, pl):
+        def measure(x, start):
+            self.stats.incr('playlist_reloads')
+            self.stats.observe('playlist_time', time.time() - start)
+            return x
+        def failed(e):
+            self.stats.incr('playlist_errors')
+            return e
+
         d = self._fetch_playlist(pl)
+        d.addCallbacks(measure, failed, callbackArgs=(time.time(),))
         d.addCallback(self._got_playlist_content, pl)
         d.addCallback(self._playlist_updated)
         return d
 
+    def _position_sequence(self, pl, position):
+        # return the sequence at position: seconds from the first listed
+        # segment, or from the end if negative, or a program date string
+        if position is None:
+            return pl.start_sequence()
+        if isinstance(position, basestring):
+            try:
+                position = float(position)
+            except ValueError:
+                sequence = pl.sequence_at_date(parse_date(position))
+                if sequence is None:
+                    logging.warning("No program date in %s to start at %s" %
+                                    (pl.url, position))
+                    return pl.start_sequence()
+                return sequence
+        return pl.sequence_at(position)
+
+    def seek(self, position):
+        # restart the downloads at position, see _position_sequence,
+        # return a defer firing with the (sequence, path, duration) of
+        # the segment there, the segments waited for fail
+        pl = self._file_playlist
+        if not pl:
+            return defer.fail(ValueError("Cannot seek before the playlist is loaded"))
+        sequence = self._position_sequence(pl, position)
+        logging.info("Seeking %s to %s, at sequence %d" %
+                     (self.url, position, sequence))
+        self.stats.incr('seeks')
+        # keep the segments following sequence, downloaded or not
+        n = sequence
+        while n in self._cached_files or n in self._download_order:
+            n += 1
+        for s in self._cached_files.keys():
+            if not sequence <= s < n:
+                self._store.release(self._cached_files.pop(s))
+        for s in list(self._download_order):
+            if sequence <= s < n:
+                continue
+            self._download_order.remove(s)
+            if self._downloading.has_key(s):
+                self._downloading.pop(s).cancel()
+            else:
+                r = self._downloaded.pop(s)
+                if r:
+                    self._store.release(r[0])
+        self._next_sequence = n
+        if self._file_listed:
+            self._file_listed.cancel()
+            self._file_listed = None
+        if self._file_allowed:
+            self._file_allowed.cancel()
+            self._file_allowed = None
+        self.segment_downloaded.fail(failure.Failure(defer.CancelledError()))
+        self._hand_over()
+        self._player_sequence = sequence
+        d = self._get_segment(sequence)
+        d.addCallback(self._playing)
+        self._get_next_file()
+        return d
+
+    def ended(self, sequence):
+        # wether sequence is past the end of an on-demand playlist
+        pl = self._file_playlist
+        return pl is not None and pl.endlist() and sequence > pl.last_sequence()
+
     def get_file(self, sequence):
-        d = defer.Deferred()
-        keys = self._cached_files.keys()
-        try:
-            sequence = ifilter(lambda x: x >= sequence, keys).next()
-            filename = self._cached_files[sequence]
-            d.callback(filename)
-        except:
-            d.addCallback(lambda x: self.get_file(sequence))
-            self._new_filed = d
-            keys.sort()
-            logging.debug('waiting for %r (available: %r)' % (sequence, keys))
+        d = self.get_segment(sequence)
+        d.addCallback(lambda x: x[1])
+        return d
+
+    def get_segment(self, sequence):
+        # return a defer firing with the (sequence, path, duration) of the
+        # first segment at or after sequence, path is None when discarded
+        self._player_sequence = sequence
+        self.stats.set('buffer', self.buffered())
+        d = self._get_segment(sequence)
+        if not d.called and not self._partials.has_key(sequence):
+            # the player may read a segment being received, see get_partial
+            self.stats.incr('stalls')
+        d.addCallback(self._playing)
+        return d
+
+    def _playing(self, segment):
+        # the player starts playing the segment
+        self._player_time = time.time()
+        return segment
+
+    def _get_segment(self, sequence):
+        cached = self._cached_files.find(sequence)
+        if cached:
+            return defer.succeed((cached[0], cached[1],
+                                  self._cached_files.duration(cached[0])))
+        logging.debug('waiting for %r (available: %r)' %
+                      (sequence, self._cached_files.keys()))
+        d = self.segment_downloaded.wait(sequence)
+        d.addCallback(lambda x: self._get_segment(sequence))
         return d
 
     def _start_get_files(self, x):
-        self._new_filed = defer.Deferred()
-        self._get_files_loop()
-        return self._new_filed
+        d = self.segment_downloaded.wait(self._next_sequence)
+        self._get_next_file()
+        return d
 
     def start(self):
-        self._files = None
-        d = self._reload_playlist(M3U8(self.url))
+        self.start_time = time.time()
+        self._media_playlist = M3U8(self.url)
+        d = self._reload_playlist(self._media_playlist)
         d.addCallback(self._start_get_files)
         return d
 
     def stop(self):
-        pass
+        self._stopped = True
+        if self._pl_task:
+            self._pl_task.stop()
+            self._pl_task = None
+        downloading = self._downloading
+        self._downloading = {}
+        for d in downloading.values():
+            d.cancel()
+        if self._seg_task and self._seg_task.active():
+            self._seg_task.cancel()
+        self._seg_task = None
+        if self._file_listed:
+            self._file_listed.cancel()
+            self._file_listed = None
+        if self._file_allowed:
+            self._file_allowed.cancel()
+            self._file_allowed = None
 
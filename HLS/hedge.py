@@ -0,0 +1,139 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import logging
+
+from twisted.internet import defer, reactor
+
+
+class HedgedRequest(object):
+    # send a request, and a hedged one to the next url when it is slower
+    # than its deadline, keeping the first to complete. Requests are
+    # cancelled after TIMEOUT deadlines, and failed ones retried on the
+    # next url after a capped exponential backoff. Hedges and timeouts
+    # wait while throttled() tells that local rates slow the requests.
+    # The deadlines of a request start once it is sent, not while it
+    # waits for a connection slot: attempt(url, n, sent) calls sent then.
+
+    MAX_TRIES = 4 # requests sent, hedges included
+    MAX_RUNNING = 2 # the request and its hedge
+    TIMEOUT = 3 # deadlines before a request is cancelled
+    BACKOFF = 0.5 # seconds before the first retry, doubled each retry
+    MAX_BACKOFF = 8.0
+
+    def __init__(self, attempt, urls, deadline, stats=None, throttled=None):
+        self._attempt = attempt # called with (url, n, sent), returns a defer
+        self.urls = urls # the primary url first, then the backups
+        self.deadline = deadline # seconds
+        self.stats = stats
+        self.throttled = throttled
+        self.deferred = None
+        self._running = {} # n -> (defer, delayed calls) of the requests
+        self._tries = 0
+        self._retries = 0
+        self._retry_call = None
+        self._stopped = False
+
+    def _incr(self, name):
+        if self.stats:
+            self.stats.incr(name)
+
+    def start(self):
+        # return a defer firing with (n, result) of the first request to
+        # complete, or the failure of the last one
+        self.deferred = defer.Deferred(lambda _: self.cancel())
+        self._send()
+        return self.deferred
+
+    def cancel(self):
+        self._stopped = True
+        if self._retry_call and self._retry_call.active():
+            self._retry_call.cancel()
+        for n in self._running.keys():
+            self._running[n][0].cancel()
+
+    def _send(self):
+        self._retry_call = None
+        n = self._tries
+        self._tries += 1
+        url = self.urls[n % len(self.urls)]
+        calls = [] # the hedge and timeout, once sent
+        def sent():
+            if calls or self._stopped:
+                return
+            calls.append(reactor.callLater(self.deadline, self._hedge, n))
+            calls.append(reactor.callLater(self.deadline * self.TIMEOUT,
+                                           self._timeout, n))
+        d = self._attempt(url, n, sent)
+        self._running[n] = (d, calls)
+        d.addCallbacks(self._done, self._failed, (n,), None, (n,))
+
+    def _finish(self, n):
+        (_, calls) = self._running.pop(n)
+        for c in calls:
+            if c.active():
+                c.cancel()
+
+    def _done(self, x, n):
+        self._finish(n)
+        if self.deferred.called:
+            return
+        if n > 0 and self._running:
+            self._incr('hedge_wins')
+        self.deferred.callback((n, x))
+        # cancel the slower one
+        self.cancel()
+
+    def _failed(self, e, n):
+        self._finish(n)
+        if self._stopped or self.deferred.called:
+            return
+        if not e.check(defer.CancelledError):
+            logging.info("Request to %s failed: %s" %
+                         (self.urls[n % len(self.urls)], e.getErrorMessage()))
+        if self._running:
+            # the other one may still complete
+            return
+        if self._tries >= self.MAX_TRIES:
+            self.deferred.errback(e)
+            return
+        delay = min(self.BACKOFF * 2 ** self._retries, self.MAX_BACKOFF)
+        self._retries += 1
+        self._incr('retries')
+        self._retry_call = reactor.callLater(delay, self._send)
+
+    def _throttled(self, n, i, f):
+        # check again after a deadline if throttled
+        if not self.throttled or not self.throttled():
+            return False
+        self._running[n][1][i] = reactor.callLater(self.deadline, f, n)
+        return True
+
+    def _hedge(self, n):
+        if self._running.has_key(n) and self._throttled(n, 0, self._hedge):
+            return
+        if not self._running.has_key(n) or \
+                len(self._running) >= self.MAX_RUNNING or \
+                self._tries >= self.MAX_TRIES:
+            return
+        logging.debug("Hedging the request to %s after %.1fs" %
+                      (self.urls[n % len(self.urls)], self.deadline))
+        self._incr('hedged_requests')
+        self._send()
+
+    def _timeout(self, n):
+        if self._running.has_key(n) and not self._throttled(n, 1, self._timeout):
+            logging.info("Request to %s timed out" %
+                         self.urls[n % len(self.urls)])
+            self._incr('timeouts')
+            self._running[n][0].cancel()
@@ -0,0 +1,222 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import urlparse
+
+from twisted.internet import defer, protocol, reactor
+from twisted.web import client, error, iweb
+from twisted.web.http_headers import Headers
+
+MAX_PER_HOST = 4
+
+_pool = None # the keep-alive connections, shared by all the clients
+
+
+def get_pool(max_per_host=MAX_PER_HOST):
+    # return the pool, keeping the idle connections of a client more
+    global _pool
+    if not _pool:
+        _pool = client.HTTPConnectionPool(reactor, persistent=True)
+        _pool.maxPersistentPerHost = 0
+    _pool.maxPersistentPerHost += max_per_host
+    return _pool
+
+
+class _FileReceiver(protocol.Protocol):
+    # write the body to file as it is received, file may be None to
+    # only count it. The first skip bytes are dropped, and the ones after
+    # length, for servers answering a range request with the whole body.
+    # The data received is given to the throttle, see scheduler._Session.
+
+    def __init__(self, file, length, skip=0, throttle=None, progress=None):
+        self.file = file
+        self.length = length
+        self.received = 0
+        self.skip = skip
+        self.throttle = throttle
+        self.progress = progress
+        self.deferred = defer.Deferred(self._cancel)
+
+    def _cancel(self, d):
+        if self.transport:
+            if self.throttle:
+                self.throttle.forget(self.transport)
+            self.transport.stopProducing()
+
+    def dataReceived(self, data):
+        if self.deferred.called:
+            return
+        if self.throttle:
+            self.throttle.received(len(data), self.transport)
+        if self.skip:
+            n = min(self.skip, len(data))
+            self.skip -= n
+            data = data[n:]
+        if self.length is not None:
+            data = data[:self.length - self.received]
+        if not data:
+            return
+        if self.file:
+            self.file.write(data)
+        self.received += len(data)
+        if self.progress:
+            self.progress(self.received, self.length)
+
+    def connectionLost(self, reason):
+        if self.throttle:
+            self.throttle.forget(self.transport)
+        if self.deferred.called:
+            return
+        if reason.check(client.ResponseDone, client.PotentialDataLoss):
+            self.deferred.callback(self.received)
+        else:
+            self.deferred.errback(reason)
+
+
+class HTTPClient(object):
+
+    # the requests of a client, a session, are limited to max_per_host
+    # at a time on each host, sharing the keep-alive connections of the
+    # process with the other clients
+
+    def __init__(self, cookies, max_per_host=None):
+        self.cookies = cookies
+        self.max_per_host = max_per_host or MAX_PER_HOST
+        self._slots = {} # (scheme, host, port) -> semaphore of the requests
+        agent = client.Agent(reactor, pool=get_pool(self.max_per_host))
+        agent = client.CookieAgent(agent, cookies)
+        self._agent = client.RedirectAgent(agent)
+        # the playlists are text, worth compressing unlike the segments
+        self._compressed_agent = client.ContentDecoderAgent(
+            self._agent, [('gzip', client.GzipDecoder)])
+
+    def _host_slots(self, url):
+        p = urlparse.urlsplit(url)
+        key = (p.scheme, p.hostname, p.port)
+        if not self._slots.has_key(key):
+            self._slots[key] = defer.DeferredSemaphore(self.max_per_host)
+        return self._slots[key]
+
+    def _request(self, url, headers, read_body, method='GET', agent=None,
+                 sent=None):
+        # run a request once a connection slot to the host is available,
+        # and hold the slot until the body has been read, sent is called
+        # when the request leaves the queue of the slots
+        def got_response(response):
+            if response.code >= 400:
+                d = client.readBody(response)
+                def failed(body):
+                    raise error.Error(str(response.code), response.phrase, body)
+                d.addCallback(failed)
+            else:
+                d = read_body(response)
+            return d
+
+        stopped = [] # set once the request is cancelled
+        def cancelled(e):
+            # a request cancelled before its response is just cancelled,
+            # even while connecting, which fails with a lookup error
+            if stopped:
+                raise defer.CancelledError()
+            e.trap(client.ResponseNeverReceived)
+            if [r for r in e.value.reasons if r.check(defer.CancelledError)]:
+                raise defer.CancelledError()
+            return e
+
+        def request():
+            if sent:
+                sent()
+            h = Headers(dict((k, [v]) for (k, v) in headers.items()))
+            d = (agent or self._agent).request(method, url, h)
+            d.addCallback(got_response)
+            d.addErrback(cancelled)
+            return d
+
+        def cancel(_):
+            stopped.append(True)
+            d.cancel()
+        d = self._host_slots(url).run(request)
+        result = defer.Deferred(cancel)
+        d.chainDeferred(result)
+        return result
+
+    def get_page(self, url, headers={}, sent=None):
+        return self._request(url, headers, client.readBody, sent=sent)
+
+    def get_playlist(self, url, headers={}, validators=None, sent=None):
+        # return a defer firing with the (body, validators) of url, gzip
+        # compressed on the wire if the server can. validators are the
+        # (etag, last modified) of a previous response, the body is None
+        # if unchanged since.
+        def read_body(response):
+            d = client.readBody(response)
+            if response.code == 304:
+                d.addCallback(lambda _: (None, validators))
+                return d
+            etag = response.headers.getRawHeaders('etag', [None])[0]
+            modified = response.headers.getRawHeaders('last-modified', [None])[0]
+            new = None
+            if etag or modified:
+                new = (etag, modified)
+            d.addCallback(lambda body: (body, new))
+            return d
+
+        headers = dict(headers)
+        if validators:
+            (etag, modified) = validators
+            if etag:
+                headers['If-None-Match'] = etag
+            if modified:
+                headers['If-Modified-Since'] = modified
+        return self._request(url, headers, read_body,
+                             agent=self._compressed_agent, sent=sent)
+
+    def get_length(self, url, headers={}, sent=None):
+        # return the Content-Length of url, or None, from a HEAD request
+        def read_body(response):
+            # a HEAD response has no body, its length is the header's
+            length = response.headers.getRawHeaders('content-length')
+            if length:
+                length = int(length[0])
+            else:
+                length = None
+            d = client.readBody(response)
+            d.addCallback(lambda _: length)
+            return d
+
+        return self._request(url, headers, read_body, 'HEAD', sent=sent)
+
+    def download(self, url, file, headers={}, byterange=None, throttle=None,
+                 sent=None, progress=None):
+        # stream the body into file. byterange is the (length, offset) to
+        # get of the body, or None for all of it. throttle limits the
+        # rate, see scheduler._Session. progress is called with the
+        # received and total (or None) number of bytes as data is written.
+        def read_body(response):
+            length = response.length
+            if length == iweb.UNKNOWN_LENGTH:
+                length = None
+            skip = 0
+            if byterange:
+                if response.code != 206:
+                    skip = byterange[1]
+                length = byterange[0]
+            p = _FileReceiver(file, length, skip, throttle, progress)
+            response.deliverBody(p)
+            return p.deferred
+
+        if byterange:
+            headers = dict(headers)
+            headers['Range'] = 'bytes=%d-%d' % (byterange[1],
+                                               byterange[1] + byterange[0] - 1)
+        return self._request(url, headers, read_body, sent=sent)
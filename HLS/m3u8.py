@@ -11,29 +11,155 @@
 # warranty of merchantability or fitness for a particular purpose.
 # See "LICENSE" in the source distribution for more information.
 
+import bisect
+import calendar
+import itertools
 import logging
+import re
+from array import array
+
+_ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+_MEDIA_SEQUENCE = re.compile(r'#EXT-X-MEDIA-SEQUENCE:\s*(\d+)')
+_RESUME = object() # resumes the parse after the files already known
+_DATE = re.compile(r'(\d{4})-(\d\d)-(\d\d)[Tt ](\d\d):(\d\d):(\d\d)(\.\d+)?'
+                   r'([Zz]|[+-]\d\d(?::?\d\d)?)?$')
+
+
+def _attributes(s):
+    # return the dict of an attribute list, quoted values may hold commas
+    return dict((k, v.strip('"')) for (k, v) in _ATTRIBUTE.findall(s))
+
+
+def parse_date(s):
+    # return the seconds since the epoch of an ISO 8601 date, as in
+    # EXT-X-PROGRAM-DATE-TIME, raise ValueError if invalid
+    m = _DATE.match(s.strip())
+    if not m:
+        raise ValueError("Invalid date %r" % s)
+    t = calendar.timegm([int(x) for x in m.groups()[:6]])
+    if m.group(7):
+        t += float(m.group(7))
+    tz = m.group(8)
+    if tz and tz not in 'Zz':
+        offset = int(tz[1:3]) * 3600 + int(tz[-2:] if len(tz) > 3 else 0) * 60
+        if tz[0] == '+':
+            offset = -offset
+        t += offset
+    return t
+
+
+class Segment(object):
+    # a media file of the playlist
+
+    __slots__ = ('file', 'duration', 'sequence', 'discontinuity',
+                 'allow_cache', 'title', 'endlist', 'byterange', 'key',
+                 'date')
+
+    def __init__(self, file, duration, sequence, discontinuity=False,
+                 allow_cache=None, title=None):
+        self.file = file
+        self.duration = duration
+        self.sequence = sequence
+        self.discontinuity = discontinuity
+        self.allow_cache = allow_cache
+        self.title = title
+        self.endlist = False
+        self.byterange = None # (length, offset) of a sub-range of file
+        self.key = None # the EXT-X-KEY dict if encrypted
+        self.date = None # the EXT-X-PROGRAM-DATE-TIME, seconds since the epoch
+
+    def __repr__(self):
+        return "<Segment %r %r %r>" % (self.sequence, self.file, self.duration)
+
+
+class SegmentIndex(object):
+    # the segments of an on-demand playlist in compact arrays, with the
+    # start time of each, the Segment objects are built when asked
+
+    def __init__(self, first_sequence, durations, uris, offsets,
+                 byteranges=None, allow_cache=None):
+        self.first_sequence = first_sequence
+        self.allow_cache = allow_cache
+        self._durations = durations # array of seconds
+        self._uris = uris # the uris end to end
+        self._offsets = offsets # array of the uri offsets, and the end
+        self._byteranges = byteranges # (lengths, offsets) arrays, or None
+        self._starts = array('d', [0.0]) # start times, and the end
+        t = 0.0
+        for d in durations:
+            t += d
+            self._starts.append(t)
+
+    def __len__(self):
+        return len(self._durations)
+
+    def __contains__(self, sequence):
+        return 0 <= sequence - self.first_sequence < len(self._durations)
+
+    def get(self, sequence, default=None):
+        i = sequence - self.first_sequence
+        if i < 0 or i >= len(self._durations):
+            return default
+        uri = self._uris[self._offsets[i]:self._offsets[i + 1]]
+        f = Segment(uri.decode('utf-8'), self._durations[i], sequence,
+                    allow_cache=self.allow_cache)
+        if self._byteranges:
+            f.byterange = (self._byteranges[0][i], self._byteranges[1][i])
+        f.endlist = i == len(self._durations) - 1
+        return f
+
+    def duration(self):
+        return self._starts[-1]
+
+    def sequence_at(self, t):
+        # the sequence playing at t seconds from the playlist start
+        i = bisect.bisect_right(self._starts, t) - 1
+        return self.first_sequence + min(max(i, 0), len(self._durations) - 1)
+
+    def __repr__(self):
+        return "<SegmentIndex %r-%r>" % (self.first_sequence,
+            self.first_sequence + len(self._durations) - 1)
 
 
 class M3U8(object):
 
+    FAST_PARSE = True # parse on-demand playlists into a SegmentIndex
+
     def __init__(self, url=None):
         self.url = url
 
         self._programs = [] # main list of programs & bandwidth
-        self._files = {} # the current program playlist
+        self._files = {} # sequence n -> Segment, within the live window
         self._first_sequence = None # the first sequence to start fetching
         self._last_sequence = None # the last sequence, to compute reload delay
-        self._reload_delay = None # the initial reload delay
         self._update_tries = None # the number consecutive reload tries
         self._last_content = None
         self._endlist = False # wether the list ended and should not be refreshed
+        self.validators = {} # url -> (etag, last modified) of the content loaded
 
     def endlist(self):
         return self._endlist
 
+    def first_sequence(self):
+        return self._first_sequence
+
+    def last_sequence(self):
+        return self._last_sequence
+
+    def start_sequence(self):
+        # the sequence to start playing from: a few segments behind the
+        # live edge, or the first of on-demand playlists
+        if not self._endlist:
+            return max(self._first_sequence, self._last_sequence - 3)
+        return self._first_sequence
+
     def has_programs(self):
         return len(self._programs) != 0
 
+    def get_programs(self):
+        # return the EXT-X-STREAM-INF dicts
+        return list(self._programs)
+
     def get_program_playlist(self, program_id=None, bitrate=None):
         # return the (uri, dict) of the best matching playlist
         if not self.has_programs():
@@ -44,56 +170,109 @@ class M3U8(object):
 
     def reload_delay(self):
         # return the time between request updates, in seconds
-        if self._endlist or not self._last_sequence:
+        if self._endlist or self._last_sequence is None:
             raise
 
         if self._update_tries == 0:
-            ld = self._files[self._last_sequence]['duration']
-            self._reload_delay = min(self.target_duration * 3, ld)
-            d = self._reload_delay
-        elif self._update_tries == 1:
-            d = self._reload_delay * 0.5
-        elif self._update_tries == 2:
-            d = self._reload_delay * 1.5
+            # the playlist changed, wait the target duration
+            d = self.target_duration
         else:
-            d = self._reload_delay * 3.0
+            # unchanged, retry after half the target duration
+            d = self.target_duration * 0.5
 
         logging.debug('Reload delay is %r' % d)
-        return int(d)
+        return d
 
     def has_files(self):
         return len(self._files) != 0
 
-    def iter_files(self):
-        # return an iter on the playlist media files
+    def get_file(self, sequence):
+        # return the Segment of sequence, or None
+        return self._files.get(sequence)
+
+    def iter_files(self, start=None):
+        # return an iter on the listed media files, from start if given
         if not self.has_files():
             return
 
-        if not self._endlist:
-            current = max(self._first_sequence, self._last_sequence - 3)
+        if start is not None:
+            current = start
         else:
-            # treat differently on-demand playlists?
-            current = self._first_sequence
+            current = self.start_sequence()
 
         while True:
-            try:
-                f = self._files[current]
-                current += 1
-                yield f
-                if (f.has_key('endlist')):
-                    break
-            except:
-                yield None
+            # skip the files that went out of the live window
+            current = max(current, self._first_sequence)
+            f = self._files.get(current)
+            if not f:
+                return
+            current += 1
+            yield f
+
+    def _time_index(self):
+        # return the start times of the listed files, and the end, and
+        # their sequences
+        starts = array('d', [0.0])
+        sequences = []
+        for f in self.iter_files(self._first_sequence):
+            sequences.append(f.sequence)
+            starts.append(starts[-1] + f.duration)
+        return starts, sequences
+
+    def sequence_at(self, t):
+        # return the sequence playing at t seconds from the first listed
+        # file, or from the end of the playlist if t is negative
+        if not self.has_files():
+            return None
+        if isinstance(self._files, SegmentIndex):
+            if t < 0:
+                t += self._files.duration()
+            return self._files.sequence_at(t)
+        (starts, sequences) = self._time_index()
+        if t < 0:
+            t += starts[-1]
+        i = bisect.bisect_right(starts, t) - 1
+        return sequences[min(max(i, 0), len(sequences) - 1)]
+
+    def sequence_at_date(self, date):
+        # return the sequence playing at date, in seconds since the
+        # epoch, from the program dates of the files, or None without
+        if not self.has_files() or isinstance(self._files, SegmentIndex):
+            return None
+        (starts, sequences) = self._time_index()
+        anchor = None # (date, start time) of the last dated file
+        for (i, sequence) in enumerate(sequences):
+            if self._files[sequence].date is not None:
+                anchor = (self._files[sequence].date, starts[i])
+                break
+        if anchor is None:
+            return None
+        # the files before the first date are timed from it
+        dates = array('d')
+        for (i, sequence) in enumerate(sequences):
+            f = self._files[sequence]
+            if f.date is not None and starts[i] >= anchor[1]:
+                anchor = (f.date, starts[i])
+            dates.append(anchor[0] + starts[i] - anchor[1])
+        i = bisect.bisect_right(dates, date) - 1
+        return sequences[max(i, 0)]
+
+    def unchanged(self):
+        # a reload found the content unchanged, without getting it
+        logging.info("Content didn't change")
+        self._update_tries += 1
 
     def update(self, content):
         # update this "constructed" playlist,
         # return wether it has actually been updated
         if self._last_content and content == self._last_content:
-            logging.info("Content didn't change")
-            self._update_tries += 1
+            self.unchanged()
             return False
 
         self._update_tries = 0
+        if self.FAST_PARSE and self._last_sequence is None and \
+                '#EXT-X-ENDLIST' in content and self._fast_update(content):
+            return True
         self._last_content = content
 
         def get_lines_iter(c):
@@ -106,19 +285,40 @@ class M3U8(object):
                 else:
                     yield l
 
-        self._lines = get_lines_iter(content)
+        known = self._split_known(content)
+        if known is None:
+            self._lines = get_lines_iter(content)
+        else:
+            (header, rest) = known
+            self._lines = itertools.chain(get_lines_iter(header), [_RESUME],
+                                          get_lines_iter(rest))
         first_line = self._lines.next()
         if not first_line.startswith('#EXTM3U'):
             logging.error('Invalid first line: %r' % first_line)
             raise
 
         self.target_duration = None
+        self.media_sequence = 0
         discontinuity = False
         allow_cache = None
+        extinf = None # the EXTINF values of the next uri
+        byterange = None
+        key = None
+        date = None # the program date of the next file
+        next_offset = 0 # where a byte range without offset starts
         i = 0
         new_files = []
         for l in self._lines:
-            if l.startswith('#EXT-X-STREAM-INF'):
+            if l is _RESUME:
+                # the state after the last known file
+                last = self._files[self._last_sequence]
+                i = self._last_sequence + 1
+                allow_cache = last.allow_cache
+                key = last.key
+                next_offset = last.byterange and sum(last.byterange) or 0
+                discontinuity = False
+                date = None
+            elif l.startswith('#EXT-X-STREAM-INF'):
                 def to_dict(l):
                     i = (f.split('=') for f in l.split(','))
                     d = dict((k.strip(), v.strip()) for (k,v) in i)
@@ -134,28 +334,51 @@ class M3U8(object):
             elif l.startswith('#EXT-X-DISCONTINUITY'):
                 discontinuity = True
             elif l.startswith('#EXT-X-PROGRAM-DATE-TIME'):
-                print l
+                try:
+                    date = parse_date(l[25:])
+                except ValueError, e:
+                    logging.warning("Ignoring %r: %s" % (l, e))
             elif l.startswith('#EXT-X-ALLOW-CACHE'):
                 allow_cache = l[19:]
+            elif l.startswith('#EXT-X-KEY'):
+                key = _attributes(l[11:])
+                if key.get('METHOD', 'NONE') == 'NONE':
+                    key = None
+            elif l.startswith('#EXT-X-BYTERANGE'):
+                v = l[17:].split('@')
+                if len(v) >= 2:
+                    next_offset = int(v[1])
+                byterange = (int(v[0]), next_offset)
+                next_offset += byterange[0]
             elif l.startswith('#EXTINF'):
-                v = l[8:].split(',')
-                d = dict(file=self._lines.next().strip(),
-                         duration=int(v[0]),
-                         sequence=i,
-                         discontinuity=discontinuity,
-                         allow_cache=allow_cache)
+                extinf = l[8:].split(',')
+            elif extinf is not None and len(l.strip()) != 0 and \
+                    not l.startswith('#'):
+                file = l.strip()
+                v, extinf = extinf, None
+                r, byterange = byterange, None
+                t, date = date, None
+                if r is None:
+                    next_offset = 0
+                if self._last_sequence is not None and i <= self._last_sequence:
+                    # already known from a previous update
+                    discontinuity = False
+                    i += 1
+                    continue
+                d = Segment(file, float(v[0]), i, discontinuity, allow_cache)
                 if len(v) >= 2:
-                    d['title'] = v[1].strip()
+                    d.title = v[1].strip()
+                d.byterange = r
+                d.key = key
+                d.date = t
                 discontinuity = False
+                self._set_file(i, d)
+                self._last_sequence = i
+                new_files.append(d)
                 i += 1
-                new = self._set_file(i, d)
-                if i > self._last_sequence:
-                    self._last_sequence = i
-                if new:
-                    new_files.append(d)
             elif l.startswith('#EXT-X-ENDLIST'):
-                if i > 0:
-                    self._files[i]['endlist'] = True
+                if self._last_sequence is not None:
+                    self._files[self._last_sequence].endlist = True
                 self._endlist = True
             elif len(l.strip()) != 0:
                 print l
@@ -163,24 +386,157 @@ class M3U8(object):
         if not self.has_programs() and not self.target_duration:
             logging.error("Invalid HLS stream: no programs & no duration")
             raise
+        if not self._endlist:
+            self._evict(self.media_sequence)
         if len(new_files):
             logging.debug("got new files in playlist: %r", new_files)
 
         return True
 
+    def _split_known(self, content):
+        # return the (header, rest) of content without the files already
+        # known from the previous update, or None to parse all of it: a
+        # live reload mostly repeats the window, the new files are last
+        if self._last_sequence is None or \
+                isinstance(self._files, SegmentIndex) or \
+                self._last_sequence not in self._files:
+            return None
+        first = content.find('#EXTINF')
+        if first < 0:
+            return None
+        m = _MEDIA_SEQUENCE.search(content, 0, first)
+        known = self._last_sequence - (m and int(m.group(1)) or 0) + 1
+        total = content.count('#EXTINF', first)
+        if known <= 0 or known > total:
+            return None
+        # the EXTINF of the last known file, counted from the end
+        pos = len(content)
+        for j in xrange(total - known + 1):
+            pos = content.rfind('#EXTINF', first, pos)
+        # then its uri line
+        end = content.find('\n', pos)
+        while end >= 0:
+            start = end + 1
+            end = content.find('\n', start)
+            l = content[start:end if end >= 0 else len(content)].strip()
+            if l and not l.startswith('#'):
+                break
+        else:
+            return None
+        if l.decode('utf-8') != self._files[self._last_sequence].file:
+            # not the window of the previous update
+            return None
+        if end < 0:
+            end = len(content)
+        return content[:first], content[end:]
+
+    def _fast_update(self, content):
+        # parse an on-demand playlist into a SegmentIndex, return False
+        # if it has tags only update knows
+        if content.startswith('\xef\xbb\xbf'):
+            content = content[3:]
+        lines = content.splitlines()
+        if not lines or not lines[0].startswith('#EXTM3U'):
+            return False
+
+        target_duration = None
+        media_sequence = 0
+        allow_cache = None
+        endlist = False
+        durations = array('d')
+        uris = []
+        offsets = array('L', [0])
+        size = 0
+        lengths = None # of the byte ranges, if any
+        range_offsets = None
+        byterange = None
+        next_offset = 0
+        duration = None
+        for l in lines:
+            if not l:
+                continue
+            if l[0] != '#':
+                if duration is None:
+                    return False
+                if (byterange is None) != (lengths is None):
+                    # some segments are byte ranges, not all
+                    if durations or byterange is None:
+                        return False
+                    lengths = array('L')
+                    range_offsets = array('L')
+                l = l.strip()
+                uris.append(l)
+                size += len(l)
+                offsets.append(size)
+                durations.append(duration)
+                duration = None
+                if byterange is not None:
+                    lengths.append(byterange[0])
+                    range_offsets.append(byterange[1])
+                    byterange = None
+            elif l.startswith('#EXTINF:'):
+                duration = float(l[8:].split(',', 1)[0])
+            elif l.startswith('#EXT-X-BYTERANGE:'):
+                v = l[17:].split('@')
+                if len(v) >= 2:
+                    next_offset = int(v[1])
+                byterange = (int(v[0]), next_offset)
+                next_offset += byterange[0]
+            elif l.startswith('#EXT-X-TARGETDURATION:'):
+                target_duration = int(l[22:])
+            elif l.startswith('#EXT-X-MEDIA-SEQUENCE:'):
+                media_sequence = int(l[22:])
+            elif l.startswith('#EXT-X-ALLOW-CACHE:'):
+                if durations:
+                    return False
+                allow_cache = l[19:]
+            elif l.startswith('#EXT-X-ENDLIST'):
+                endlist = True
+            elif l.startswith('#EXTM3U') or l.startswith('#EXT-X-VERSION') or \
+                    l.startswith('#EXT-X-PLAYLIST-TYPE'):
+                pass
+            elif l.startswith('#EXT'):
+                return False
+        if not endlist or not durations or not target_duration:
+            return False
+
+        byteranges = None
+        if lengths is not None:
+            byteranges = (lengths, range_offsets)
+        self.target_duration = target_duration
+        self.media_sequence = media_sequence
+        self._files = SegmentIndex(media_sequence, durations, ''.join(uris),
+                                   offsets, byteranges, allow_cache)
+        self._first_sequence = media_sequence
+        self._last_sequence = media_sequence + len(durations) - 1
+        self._endlist = True
+        logging.debug("Indexed %d files of %r" % (len(durations), self.url))
+        return True
+
+    def _evict(self, sequence):
+        # forget the files before sequence, out of the live window
+        if self._first_sequence is None:
+            return
+        sequence = min(sequence, self._last_sequence)
+        # the files listed, not the sequences skipped: the media sequence
+        # may jump far ahead
+        for i in [s for s in self._files.keys() if s < sequence]:
+            del self._files[i]
+        self._first_sequence = max(self._first_sequence, sequence)
+
     def _add_playlist(self, d):
+        # the entries of an already listed bandwidth are its backups
+        for p in self._programs:
+            if p.get('BANDWIDTH') == d.get('BANDWIDTH') and \
+                    p.get('PROGRAM-ID') == d.get('PROGRAM-ID'):
+                p.setdefault('backups', []).append(d['uri'])
+                return
         self._programs.append(d)
 
     def _set_file(self, sequence, d):
-        new = False
-        if not self._files.has_key(sequence):
-            new = True
-        if not self._first_sequence:
-            self._first_sequence = sequence
-        elif sequence < self._first_sequence:
+        if self._first_sequence is None or sequence < self._first_sequence:
             self._first_sequence = sequence
         self._files[sequence] = d
-        return new
 
     def __repr__(self):
         return "M3U8 %r %r" % (self._programs, self._files)
@@ -0,0 +1,63 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import bisect
+import itertools
+
+from twisted.internet import defer
+
+
+class SequenceNotifier(object):
+    # the waiters of an event on sequence numbers: a waiter of a sequence
+    # fires at the first event of a sequence at or after it. Waiters
+    # should check the state before waiting, an event is not kept.
+
+    def __init__(self):
+        self._waiters = [] # sorted (sequence, n, defer)
+        self._n = itertools.count() # keeps the waiters of a sequence in order
+
+    def __len__(self):
+        return len(self._waiters)
+
+    def wait(self, sequence):
+        # return a defer firing with the value of the event
+        def cancel(d):
+            for (i, w) in enumerate(self._waiters):
+                if w[2] is d:
+                    del self._waiters[i]
+                    break
+        d = defer.Deferred(cancel)
+        bisect.insort(self._waiters, (sequence, self._n.next(), d))
+        return d
+
+    def _pop(self, sequence):
+        # remove and return the waiters up to sequence included, the ones
+        # added while they fire wait for a next event
+        i = bisect.bisect_right(self._waiters, (sequence, float('inf')))
+        waiters = self._waiters[:i]
+        del self._waiters[:i]
+        return [d for (_, _, d) in waiters]
+
+    def notify(self, sequence, value=None):
+        for d in self._pop(sequence):
+            d.callback(value)
+
+    def fail(self, failure, sequence=None):
+        # errback the waiters up to sequence, or all of them
+        if sequence is None:
+            waiters = [d for (_, _, d) in self._waiters]
+            self._waiters = []
+        else:
+            waiters = self._pop(sequence)
+        for d in waiters:
+            d.errback(failure)
@@ -0,0 +1,251 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+# A local HLS origin, serving a master playlist with several variants
+# of a live (sliding window) or on-demand stream, with configurable
+# segment size, latency, bandwidth and errors, to test and benchmark
+# the player offline.
+
+import email.utils
+import hashlib
+import json
+import optparse
+import random
+import sys
+import time
+import zlib
+
+from twisted.internet import reactor, task
+from twisted.web import resource, server
+
+
+class Origin(resource.Resource):
+
+    isLeaf = True
+
+    def __init__(self, variants=(200000, 800000), duration=2, live=True,
+                 window=6, segments=30, segment_size=None, latency=0.0,
+                 bandwidth=None, error_rate=0.0, conditional=True):
+        resource.Resource.__init__(self)
+        self.variants = variants # bits per second
+        self.duration = duration # of the segments, in seconds
+        self.live = live
+        self.window = window # segments in the live playlists
+        self.segments = segments # segments of the on-demand playlists
+        self.segment_size = segment_size # bytes, from the variant if None
+        self.latency = latency # seconds before the response starts
+        self.bandwidth = bandwidth # bytes per second of each response
+        self.error_rate = error_rate # probability of a 500 response
+        self.conditional = conditional # validators and gzip on playlists
+        self.start_time = time.time()
+        self.requests = dict(master=0, playlist=0, segment=0, error=0,
+                             not_modified=0)
+        self.bytes_sent = 0
+        self.playlist_bytes_sent = 0
+
+    def _current(self):
+        # the last available sequence
+        if not self.live:
+            return self.segments - 1
+        return int((time.time() - self.start_time) / self.duration) + \
+            self.window - 1
+
+    def _modified(self):
+        # the time the playlists last changed
+        if not self.live:
+            return self.start_time
+        return self.start_time + \
+            (self._current() - self.window + 1) * self.duration
+
+    def master(self):
+        lines = ['#EXTM3U']
+        for bw in self.variants:
+            lines.append('#EXT-X-STREAM-INF:PROGRAM-ID=1,BANDWIDTH=%d' % bw)
+            lines.append('%d/index.m3u8' % bw)
+        return '\n'.join(lines) + '\n'
+
+    def playlist(self, bw):
+        last = self._current()
+        first = max(0, last - self.window + 1) if self.live else 0
+        lines = ['#EXTM3U',
+                 '#EXT-X-TARGETDURATION:%d' % self.duration,
+                 '#EXT-X-MEDIA-SEQUENCE:%d' % first]
+        for i in range(first, last + 1):
+            lines.append('#EXTINF:%d,' % self.duration)
+            lines.append('seg%d.ts' % i)
+        if not self.live:
+            lines.append('#EXT-X-ENDLIST')
+        return '\n'.join(lines) + '\n'
+
+    def segment(self, bw, sequence):
+        if sequence < 0 or sequence > self._current():
+            return None
+        size = self.segment_size or bw * self.duration / 8
+        return chr(sequence % 256) * size
+
+    def _route(self, path):
+        # return (kind, body) of path, body is None if not found
+        parts = path.strip('/').split('/')
+        if parts == ['master.m3u8']:
+            return 'master', self.master()
+        if len(parts) == 2 and parts[0].isdigit() and \
+                int(parts[0]) in self.variants:
+            bw = int(parts[0])
+            if parts[1] == 'index.m3u8':
+                return 'playlist', self.playlist(bw)
+            if parts[1].startswith('seg') and parts[1].endswith('.ts') and \
+                    parts[1][3:-3].isdigit():
+                return 'segment', self.segment(bw, int(parts[1][3:-3]))
+        if parts == ['stats']:
+            return 'stats', json.dumps(dict(
+                    requests=self.requests, bytes_sent=self.bytes_sent,
+                    playlist_bytes_sent=self.playlist_bytes_sent))
+        return None, None
+
+    def render_GET(self, request):
+        kind, body = self._route(request.path)
+        if kind in self.requests:
+            self.requests[kind] += 1
+        if body is None:
+            request.setResponseCode(404)
+            return 'Not Found'
+        if kind != 'stats' and random.random() < self.error_rate:
+            self.requests['error'] += 1
+            request.setResponseCode(500)
+            return 'Injected error'
+        if kind in ('master', 'playlist'):
+            request.setHeader('Content-Type', 'application/vnd.apple.mpegurl')
+            if self.conditional:
+                body = self._conditional(request, body)
+                if body is None:
+                    self.requests['not_modified'] += 1
+                    request.setResponseCode(304)
+                    return ''
+            self.playlist_bytes_sent += len(body)
+        request.setHeader('Content-Length', str(len(body)))
+        if self.latency:
+            call = reactor.callLater(self.latency, self._send, request, body)
+            def lost(_):
+                if call.active():
+                    call.cancel()
+            request.notifyFinish().addErrback(lost)
+        else:
+            self._send(request, body)
+        return server.NOT_DONE_YET
+
+    def _conditional(self, request, body):
+        # set the validators of a playlist, return its body, gzip
+        # compressed if accepted, or None if the client has it already
+        etag = '"%s"' % hashlib.md5(body).hexdigest()[:16]
+        modified = email.utils.formatdate(self._modified(), usegmt=True)
+        request.setHeader('ETag', etag)
+        request.setHeader('Last-Modified', modified)
+        match = request.getHeader('if-none-match')
+        if match is not None:
+            if etag in [x.strip() for x in match.split(',')]:
+                return None
+        elif request.getHeader('if-modified-since') == modified:
+            return None
+        if 'gzip' in (request.getHeader('accept-encoding') or ''):
+            c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            body = c.compress(body) + c.flush()
+            request.setHeader('Content-Encoding', 'gzip')
+        return body
+
+    def _send(self, request, body):
+        if not self.bandwidth:
+            self._write(request, body)
+            request.finish()
+            return
+
+        # write at most bandwidth bytes per second, in 50ms slices
+        chunk = max(1, int(self.bandwidth * 0.05))
+        data = [body]
+        def write():
+            if not data[0]:
+                loop.stop()
+                request.finish()
+                return
+            self._write(request, data[0][:chunk])
+            data[0] = data[0][chunk:]
+        def lost(_):
+            if loop.running:
+                loop.stop()
+        loop = task.LoopingCall(write)
+        request.notifyFinish().addErrback(lost)
+        loop.start(0.05)
+
+    def _write(self, request, data):
+        self.bytes_sent += len(data)
+        request.write(data)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-p', '--port', action="store",
+                      dest='port', default=8080, type="int",
+                      help='port to listen on (default: %default)')
+    parser.add_option('-b', '--variants', action="store",
+                      dest='variants', default='200000,800000',
+                      help='comma separated variant bitrates (default: %default)')
+    parser.add_option('-t', '--duration', action="store",
+                      dest='duration', default=2, type="int",
+                      help='segment duration in seconds (default: %default)')
+    parser.add_option('--vod', action="store_true",
+                      dest='vod', default=False,
+                      help='serve on-demand playlists (default: live)')
+    parser.add_option('-w', '--window', action="store",
+                      dest='window', default=6, type="int",
+                      help='segments in the live window (default: %default)')
+    parser.add_option('-n', '--segments', action="store",
+                      dest='segments', default=30, type="int",
+                      help='segments of the on-demand playlists (default: %default)')
+    parser.add_option('-s', '--segment-size', action="store",
+                      dest='segment_size', default=None, type="int",
+                      help='segment size in bytes (default: from the bitrate)')
+    parser.add_option('-l', '--latency', action="store",
+                      dest='latency', default=0.0, type="float",
+                      help='seconds before each response (default: %default)')
+    parser.add_option('-B', '--bandwidth', action="store",
+                      dest='bandwidth', default=None, type="int",
+                      help='bytes per second of each response (default: unlimited)')
+    parser.add_option('-e', '--error-rate', action="store",
+                      dest='error_rate', default=0.0, type="float",
+                      help='probability of a 500 response (default: %default)')
+    parser.add_option('--plain-playlists', action="store_true",
+                      dest='plain_playlists', default=False,
+                      help='serve the playlists without validators nor gzip '
+                      '(default: %default)')
+    parser.add_option('-v', '--verbose', action="store_true",
+                      dest='verbose', default=False,
+                      help='log the requests (default: %default)')
+    options, args = parser.parse_args()
+
+    origin = Origin(variants=[int(x) for x in options.variants.split(',')],
+                    duration=options.duration, live=not options.vod,
+                    window=options.window, segments=options.segments,
+                    segment_size=options.segment_size,
+                    latency=options.latency, bandwidth=options.bandwidth,
+                    error_rate=options.error_rate,
+                    conditional=not options.plain_playlists)
+    site = server.Site(origin)
+    if not options.verbose:
+        site.log = lambda request: None
+    reactor.listenTCP(options.port, site, backlog=1024)
+    print 'Serving http://localhost:%d/master.m3u8' % options.port
+    sys.stdout.flush()
+    reactor.run()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
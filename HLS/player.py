@@ -18,19 +18,15 @@ import sys
 import urlparse
 import optparse
 import logging
+import mmap
 import os
-
-import pygtk, gtk, gobject
-gobject.threads_init()
-
-from twisted.internet import gtk2reactor
-gtk2reactor.install()
-from twisted.internet import reactor
-from twisted.python import log
+import threading
+import time
 
 from HLS import __version__
-from HLS.fetcher import HLSFetcher
-from HLS.m3u8 import M3U8
+
+# GTK, GStreamer and the modules importing the reactor are imported once
+# the reactor of the mode is installed, see install_reactor
 
 if sys.version_info < (2, 4):
     raise ImportError("Cannot run with Python version < 2.4")
@@ -48,13 +44,14 @@ class HLSControler:
     def set_player(self, player):
         self.player = player
         if player:
+            self.player.stats = self.fetcher.stats
             self.player.connect_about_to_finish(self.on_player_about_to_finish)
             self._n_segments_keep = self.fetcher.n_segments_keep
             self.fetcher.n_segments_keep = -1
 
     def _start(self, first_file):
         (path, l, f) = first_file
-        self._player_sequence = f['sequence']
+        self._player_sequence = f.sequence
         if self.player:
             self.player.set_uri(path)
             self.player.play()
@@ -63,25 +60,62 @@ class HLSControler:
         d = self.fetcher.start()
         d.addCallback(self._start)
 
+    def seek(self, position):
+        # play from position, see HLSFetcher.seek
+        d = self.fetcher.seek(position)
+        d.addCallback(self._seeked)
+        return d
+
+    def _seeked(self, segment):
+        (sequence, path, duration) = segment
+        self._player_sequence = sequence
+        if self.player:
+            self.player.flush()
+            self.player.set_uri(path)
+
     def _set_next_uri(self):
+        from twisted.internet import defer
         # keep only the past three segments
         if self._n_segments_keep != -1:
-            self.fetcher.delete_cache(lambda x:
-                x <= self._player_sequence - self._n_segments_keep)
+            self.fetcher.delete_cache(self._player_sequence - self._n_segments_keep)
         self._player_sequence += 1
-        d = self.fetcher.get_file(self._player_sequence)
-        d.addCallback(self.player.set_uri)
+        sequence = self._player_sequence
+        # start reading the segment while it is received
+        path = self.fetcher.get_partial(sequence, self.player.data_received)
+        if path:
+            self.player.set_uri(path, complete=False)
+        d = self.fetcher.get_segment(sequence)
+        d.addCallback(self._got_segment, sequence, path)
+        # a seek fails the segment waited for
+        d.addErrback(lambda e: e.trap(defer.CancelledError))
+
+    def _got_segment(self, segment, sequence, partial):
+        (s, path, duration) = segment
+        self._player_sequence = s
+        if not partial:
+            self.player.set_uri(path)
+        elif s == sequence:
+            self.player.complete(path)
+        else:
+            # it failed, the next one is played after the data received
+            self.player.complete(None)
+            self.player.set_uri(path)
 
     def on_player_about_to_finish(self):
+        from twisted.internet import reactor
         reactor.callFromThread(self._set_next_uri)
 
 
 class GSTPlayer:
 
+    CHUNK_SIZE = 4096 # pushed when need-data doesn't tell the length
+
     def __init__(self, display=True):
         import pygst
         import gst
         if display:
+            import gtk
+            from twisted.internet import reactor
             self.window = gtk.Window(gtk.WINDOW_TOPLEVEL)
             self.window.set_title("Video-Player")
             self.window.set_default_size(500, 400)
@@ -113,7 +147,16 @@ class GSTPlayer:
         bus.connect("sync-message::element", self.on_sync_message)
         self._playing = False
         self._need_data = False
+        self._need_length = -1
         self._cb = None
+        self._lock = threading.Lock() # need-data is called from a gst thread
+        self._segments = [] # the queued [path, complete] of the segments
+        self._data = None # the mapped segment being pushed
+        self._fd = None # or the file descriptor of a partial one
+        self._growing = False # wether _fd is still being received
+        self._offset = 0
+        self._requested = False # wether the next segment was requested
+        self.stats = None
 
     def need_data(self):
         return self._need_data
@@ -128,15 +171,145 @@ class GSTPlayer:
         self.player.set_state(gst.STATE_NULL)
         self._playing = False
 
-    def set_uri(self, filepath):
-        import gst
-        logging.debug("Pushing %r to appsrc" % filepath)
+    def set_uri(self, filepath, complete=True):
+        # queue a segment file, an incomplete one is read as it grows
+        # until complete() is called
+        logging.debug("Queueing %r for appsrc" % filepath)
         # FIXME: BIG hack to reduce the initial starting time...
-        queue0 = self.decodebin.get_by_name("multiqueue0")
-        if queue0:
-            queue0.set_property("max-size-bytes", 100000)
-        f = open(filepath)
-        self.appsrc.emit('push-buffer', gst.Buffer(f.read()))
+        if hasattr(self, 'decodebin'):
+            queue0 = self.decodebin.get_by_name("multiqueue0")
+            if queue0:
+                queue0.set_property("max-size-bytes", 100000)
+        self._lock.acquire()
+        try:
+            self._segments.append([filepath, complete])
+            self._requested = False
+            if self._need_data:
+                self._push_chunk(self._need_length)
+        finally:
+            self._lock.release()
+
+    def data_received(self):
+        # the incomplete segment grew
+        self._lock.acquire()
+        try:
+            if self._need_data:
+                self._push_chunk(self._need_length)
+        finally:
+            self._lock.release()
+
+    def complete(self, filepath):
+        # the incomplete segment was downloaded to filepath, or failed if
+        # None and only the data received is played
+        self._lock.acquire()
+        try:
+            for s in self._segments:
+                if not s[1]:
+                    if filepath:
+                        s[:] = [filepath, True]
+                    else:
+                        self._segments.remove(s)
+                    break
+            else:
+                if self._growing and filepath:
+                    # the data may have been received by another request
+                    # of the download, written to another file
+                    fd = os.open(filepath, os.O_RDONLY)
+                    os.lseek(fd, self._offset, os.SEEK_SET)
+                    os.close(self._fd)
+                    self._fd = fd
+                self._growing = False
+            if self._need_data:
+                self._push_chunk(self._need_length)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        # drop the queued segments and the data in the pipeline, before
+        # queueing the segments of a new position
+        import gst
+        self._lock.acquire()
+        try:
+            self._segments = []
+            self._close()
+            self._offset = 0
+            self._requested = False
+        finally:
+            self._lock.release()
+        pad = self.appsrc.get_pad('src')
+        pad.push_event(gst.event_new_flush_start())
+        pad.push_event(gst.event_new_flush_stop())
+
+    def _close(self):
+        if self._data:
+            self._data.close()
+            self._data = None
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._growing = False
+
+    def _next_segment(self):
+        self._close()
+        self._offset = 0
+        while self._segments and not self._data:
+            (path, complete) = self._segments[0]
+            if not complete:
+                # read with os.read, stdio doesn't see a file grow past
+                # its end
+                try:
+                    self._fd = os.open(path, os.O_RDONLY)
+                except EnvironmentError:
+                    # renamed or replaced, complete() is coming
+                    return
+                self._growing = True
+                self._segments.pop(0)
+                return
+            self._segments.pop(0)
+            f = open(path, 'rb')
+            try:
+                self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (ValueError, EnvironmentError), e:
+                logging.error("Cannot map segment: %r" % e)
+            f.close()
+
+    def _read(self, length):
+        # return the next chunk of the current segment, '' at its end or
+        # None while waiting for an incomplete one to grow
+        if self._data:
+            chunk = self._data[self._offset:self._offset + length]
+        elif self._fd is not None:
+            chunk = os.read(self._fd, length)
+            if not chunk and self._growing:
+                return None
+        else:
+            return ''
+        self._offset += len(chunk)
+        return chunk
+
+    def _push_chunk(self, length):
+        # push a chunk of the current segment, and ask for the next
+        # segment once the last one queued is being pushed
+        import gst
+        if length <= 0:
+            length = self.CHUNK_SIZE
+        chunk = self._read(length)
+        if chunk == '':
+            self._next_segment()
+            chunk = self._read(length)
+        if not self._segments and not self._requested:
+            self._requested = True
+            self._on_about_to_finish()
+        if chunk is None:
+            # waiting for data_received
+            return
+        if not chunk:
+            # need-data found no segment ready
+            if self.stats:
+                self.stats.incr('player_stalls')
+            return
+        self._need_data = False
+        self.appsrc.emit('push-buffer', gst.Buffer(chunk))
 
     def on_message(self, bus, message):
         import gst
@@ -157,6 +330,7 @@ class GSTPlayer:
             return
         message_name = message.structure.get_name()
         if message_name == "prepare-xwindow-id":
+            import gtk
             imagesink = message.src
             gtk.gdk.threads_enter()
             gtk.gdk.display_get_default().sync()
@@ -202,13 +376,18 @@ class GSTPlayer:
             sink_pad = q2.get_pad("sink")
             pad.link(sink_pad)
 
-    def on_enough_data(self):
+    def on_enough_data(self, src):
         logging.info("Player is full up!");
         self._need_data = False;
 
     def on_need_data(self, src, length):
-        self._need_data = True;
-        self._on_about_to_finish()
+        self._lock.acquire()
+        try:
+            self._need_data = True
+            self._need_length = length
+            self._push_chunk(length)
+        finally:
+            self._lock.release()
 
     def _on_about_to_finish(self, p=None):
         if self._cb:
@@ -218,8 +397,35 @@ class GSTPlayer:
         self._cb = cb
 
 
+def install_reactor(display=True, pipeline=True):
+    # install the reactor of the mode, and return its name: GTK's to
+    # display, glib's to run a pipeline without display, otherwise the
+    # fastest of the platform
+    if display:
+        import pygtk, gtk, gobject
+        gobject.threads_init()
+        gtk.gdk.threads_init()
+        from twisted.internet import gtk2reactor
+        gtk2reactor.install()
+        return 'gtk2'
+    if pipeline:
+        import gobject
+        gobject.threads_init()
+        from twisted.internet import glib2reactor
+        glib2reactor.install()
+        return 'glib2'
+    try:
+        from twisted.internet import epollreactor
+        epollreactor.install()
+        return 'epoll'
+    except ImportError:
+        from twisted.internet import default
+        default.install()
+        return 'default'
+
+
 def main():
-    gtk.gdk.threads_init()
+    start_time = time.time()
 
     parser = optparse.OptionParser(usage='%prog [options] url...',
                                    version="%prog " + __version__)
@@ -231,8 +437,26 @@ def main():
                       dest='bitrate', default=200000, type="int",
                       help='desired bitrate (default: %default)')
     parser.add_option('-u', '--buffer', action="store", metavar="N",
-                      dest='buffer', default=3, type="int",
-                      help='pre-buffer N segments at start')
+                      dest='buffer', default='3',
+                      help='download as fast as possible below N segments, or N seconds as in 10s, ahead of the player (default: %default)')
+    parser.add_option('--max-buffer', action="store", metavar="N",
+                      dest='max_buffer', default=None,
+                      help='pause downloading above N segments, or N seconds, ahead of the player (default: twice the buffer)')
+    parser.add_option('-P', '--parallel', action="store", metavar="N",
+                      dest='parallel', default=3, type="int",
+                      help='download up to N segments in parallel (default: %default)')
+    parser.add_option('-C', '--connections', action="store", metavar="N",
+                      dest='connections', default=4, type="int",
+                      help='connections per host of each session (default: %default)')
+    parser.add_option('-F', '--fast-start', action="store_true",
+                      dest='fast_start', default=False,
+                      help='start on the lowest bitrate, and the first segment alone (default: %default)')
+    parser.add_option('-t', '--start', action="store", metavar="POSITION",
+                      dest='start', default=None,
+                      help='start at POSITION seconds, from the end or the live edge if negative, or at an ISO 8601 program date')
+    parser.add_option('-a', '--abr', action="store_true",
+                      dest='abr', default=False,
+                      help='adapt the bitrate to the measured throughput (default: %default)')
     parser.add_option('-k', '--keep', action="store",
                       dest='keep', default=3, type="int",
                       help='number of segments ot keep (default: %default, -1: unlimited)')
@@ -248,15 +472,66 @@ def main():
     parser.add_option('-p', '--path', action="store", metavar="PATH",
                       dest='path', default=None,
                       help='download files to PATH')
+    parser.add_option('-c', '--cache-size', action="store", metavar="MB",
+                      dest='cache_size', default=1024, type="int",
+                      help='megabytes of on-demand segments kept in PATH for later runs (default: %default)')
     parser.add_option('-n', '--number', action="store",
                       dest='n', default=1, type="int",
                       help='number of player to start (default: %default)')
+    parser.add_option('--stats-port', action="store", metavar="PORT",
+                      dest='stats_port', default=None, type="int",
+                      help='serve the stats as JSON on localhost:PORT')
+    parser.add_option('--stats-file', action="store", metavar="FILE",
+                      dest='stats_file', default=None,
+                      help='dump the stats as JSON to FILE periodically')
+    parser.add_option('--stats-interval', action="store", metavar="SECONDS",
+                      dest='stats_interval', default=10, type="float",
+                      help='seconds between two stats dumps (default: %default)')
+    parser.add_option('--rate', action="store", metavar="BPS",
+                      dest='rate', default=None, type="int",
+                      help='limit the downloads of all the players to BPS bits per second, the least buffered first')
+    parser.add_option('--session-rate', action="store", metavar="BPS",
+                      dest='session_rate', default=None, type="int",
+                      help='limit the downloads of each player to BPS bits per second')
+    parser.add_option('-V', '--virtual', action="store_true",
+                      dest='virtual', default=False,
+                      help='simulate viewers, without decoding nor storing segments (default: %default)')
+    parser.add_option('-o', '--output', action="store", metavar="FILE",
+                      dest='output', default=None,
+                      help='download an on-demand stream to FILE, without playing it')
 
     options, args = parser.parse_args()
 
     if len(args) == 0:
         parser.print_help()
         sys.exit(1)
+    from HLS.buffer import parse_amount
+    for value in (options.buffer, options.max_buffer):
+        try:
+            if value is not None:
+                parse_amount(value)
+        except ValueError:
+            parser.error("Invalid buffer %r" % value)
+    if options.start is not None:
+        from HLS.m3u8 import parse_date
+        try:
+            float(options.start)
+        except ValueError:
+            try:
+                parse_date(options.start)
+            except ValueError, e:
+                parser.error(str(e))
+
+    headless = options.virtual or options.output or options.nodisplay
+    mode = install_reactor(display=not headless and not options.save,
+                           pipeline=not headless)
+    from twisted.internet import defer, reactor
+    from twisted.python import log
+    from HLS import scheduler, stats
+    from HLS.archive import HLSArchiver
+    from HLS.cache import SegmentStore
+    from HLS.fetcher import HLSFetcher
+    from HLS.viewer import VirtualViewer, print_report
 
     log.PythonLoggingObserver().start()
     if options.verbose:
@@ -264,6 +539,42 @@ def main():
                             format='%(asctime)s %(levelname)-8s %(message)s',
                             datefmt='%d %b %Y %H:%M:%S')
 
+    def started():
+        stats.registry.startup_time = time.time() - start_time
+        logging.info("Started with the %s reactor in %.3fs" %
+                     (mode, stats.registry.startup_time))
+    reactor.callWhenRunning(started)
+
+    scheduler.bandwidth.configure(options.rate, options.session_rate)
+    if options.stats_port:
+        stats.serve(options.stats_port)
+    if options.stats_file:
+        stats.dump(options.stats_file, options.stats_interval)
+
+    if options.output:
+        url = args[0]
+        if urlparse.urlsplit(url).scheme == '':
+            url = "http://" + url
+        result = []
+        def done(x):
+            result.append(x)
+            if reactor.running:
+                reactor.stop()
+        def failed(e):
+            if e.check(defer.FirstError):
+                e = e.value.subFailure
+            logging.error("Download failed: %s" % e.getErrorMessage())
+            return False
+        a = HLSArchiver(url, options.output, options)
+        reactor.callWhenRunning(lambda: a.start().addErrback(failed).addBoth(done))
+        reactor.run()
+        if not result or result[0] is False:
+            sys.exit(1)
+        return
+
+    # the sessions share the segments they download
+    store = SegmentStore(options.path, options.cache_size * 1024 * 1024)
+    viewers = []
     n = 0
     for url in args:
         for l in range(options.n):
@@ -271,15 +582,27 @@ def main():
             if urlparse.urlsplit(url).scheme == '':
                 url = "http://" + url
 
-            c = HLSControler(HLSFetcher(url, options))
-            if not options.nodisplay:
-                p = GSTPlayer(display = not options.save)
-                c.set_player(p)
+            if options.virtual:
+                c = VirtualViewer(HLSFetcher(url, options), "session %d" % n)
+                viewers.append(c)
+            else:
+                c = HLSControler(HLSFetcher(url, options, store=store))
+                if not options.nodisplay:
+                    p = GSTPlayer(display = not options.save)
+                    c.set_player(p)
 
             delay = 10.0 / options.n * n
             n += 1
             reactor.callLater(delay, c.start)
 
+    if viewers:
+        def stop(_):
+            if reactor.running:
+                reactor.stop()
+        reactor.addSystemEventTrigger('before', 'shutdown', print_report, viewers)
+        d = defer.DeferredList([v.finished for v in viewers])
+        d.addCallback(stop)
+
     reactor.run()
 
 
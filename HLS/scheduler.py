@@ -0,0 +1,168 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+from twisted.internet import defer, reactor
+
+BURST = 0.5 # seconds of the rate a bucket holds
+MIN_BURST = 64 * 1024 # bytes, so that a read of the socket fits
+QUANTUM = 0.05 # seconds between two transports resumed on the process rate
+
+
+class TokenBucket(object):
+    # tokens of bytes refilled at rate bytes per second, taken by the
+    # data received, the bucket may be in debt
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate * BURST, MIN_BURST)
+        self.tokens = self.burst
+        self._time = reactor.seconds()
+
+    def _refill(self):
+        now = reactor.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def take(self, nbytes):
+        self._refill()
+        self.tokens -= nbytes
+
+    def delay(self):
+        # return the seconds before the debt is paid
+        self._refill()
+        return max(0, -self.tokens / self.rate)
+
+
+class _Session(object):
+    # the downloads of a session, see Scheduler.session
+
+    def __init__(self, scheduler, buffered, stats=None, rate=None):
+        self.scheduler = scheduler
+        self.buffered = buffered
+        self.stats = stats
+        self.bucket = None
+        if rate:
+            self.bucket = TokenBucket(rate)
+
+    def received(self, nbytes, transport):
+        # take nbytes received by transport, pausing it if over the rate
+        self.scheduler._received(self, nbytes, transport)
+
+    def forget(self, transport):
+        # the transport is done, don't resume it
+        self.scheduler._forget(transport)
+
+    def wait(self):
+        # return a defer firing once the session may start a download
+        return self.scheduler._wait(self)
+
+    def throttled(self):
+        # wether the session is slowed down by the rates
+        return self.scheduler._throttled(self)
+
+
+class Scheduler(object):
+    # the bandwidth of the sessions of the process: the data received is
+    # taken from the tokens of the process and of its session, the
+    # transports over either rate are paused, and resumed the session
+    # with the least media buffered first, so that the bandwidth goes
+    # where a stall is the closest
+
+    def __init__(self):
+        self.rate = None # bits per second of the process, or None
+        self.session_rate = None # bits per second of each session
+        self._bucket = None
+        self._waiting = [] # (session, key, resume) paused transports and waits
+        self._call = None
+
+    def configure(self, rate=None, session_rate=None):
+        self.rate = rate
+        self.session_rate = session_rate
+        self._bucket = None
+        if rate:
+            self._bucket = TokenBucket(rate / 8.0)
+
+    def session(self, buffered, stats=None):
+        # return the scheduler of a session, buffered() returning the
+        # seconds of media it has ahead of its player
+        return _Session(self, buffered, stats,
+                        self.session_rate and self.session_rate / 8.0)
+
+    def _delay(self, session):
+        # the seconds before a transport of session may be resumed
+        d = 0
+        if session.bucket:
+            d = session.bucket.delay()
+        if self._bucket:
+            d = max(d, self._bucket.delay())
+        return d
+
+    def _received(self, session, nbytes, transport):
+        if self._bucket:
+            self._bucket.take(nbytes)
+        if session.bucket:
+            session.bucket.take(nbytes)
+        if self._delay(session) <= 0:
+            return
+        if session.stats:
+            session.stats.incr('throttled')
+        transport.pauseProducing()
+        self._waiting.append((session, transport, transport.resumeProducing))
+        self._schedule()
+
+    def _forget(self, key):
+        self._waiting = [w for w in self._waiting if w[1] is not key]
+
+    def _throttled(self, session):
+        if self._delay(session) > 0:
+            return True
+        for w in self._waiting:
+            if w[0] is session:
+                return True
+        return False
+
+    def _wait(self, session):
+        if not self._throttled(session):
+            return defer.succeed(None)
+        d = defer.Deferred(self._forget)
+        self._waiting.append((session, d, lambda: d.callback(None)))
+        self._schedule()
+        return d
+
+    def _schedule(self, delay=0):
+        if not self._waiting:
+            return
+        delay = max(delay, min(self._delay(w[0]) for w in self._waiting))
+        if self._call and self._call.active():
+            if self._call.getTime() <= reactor.seconds() + delay:
+                return
+            self._call.cancel()
+        self._call = reactor.callLater(delay, self._resume)
+
+    def _resume(self):
+        self._call = None
+        # timers may fire a little early
+        ready = [w for w in self._waiting if self._delay(w[0]) < 0.001]
+        ready.sort(key=lambda w: w[0].buffered())
+        if self._bucket:
+            # the process tokens go to the least buffered first, the
+            # others wait to see what it takes
+            ready = ready[:1]
+        for w in ready:
+            if w in self._waiting:
+                self._waiting.remove(w)
+                w[2]()
+        self._schedule(self._bucket and ready and QUANTUM or 0)
+
+
+bandwidth = Scheduler()
@@ -0,0 +1,173 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import bisect
+import json
+import logging
+import os
+import time
+
+from twisted.internet import reactor, task
+from twisted.web import resource, server
+
+TIME_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+BITRATE_BUCKETS = (1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 1e8)
+# the gauges whose sum over the sessions means something, the others are
+# per session times, see their histograms
+ADDITIVE_GAUGES = ('buffer',)
+
+
+class Histogram(object):
+
+    def __init__(self, buckets=TIME_BUCKETS):
+        self.buckets = buckets # upper bounds, the last bucket is unbounded
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.sum += other.sum
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    def to_dict(self):
+        d = dict(count=self.count, sum=self.sum, min=self.min, max=self.max,
+                 buckets=zip(list(self.buckets) + ['+Inf'], self.counts))
+        if self.count:
+            d['avg'] = self.sum / self.count
+        return d
+
+
+class Stats(object):
+    # the counters, gauges and histograms of a session
+
+    def __init__(self, name):
+        self.name = name
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def incr(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def observe(self, name, value, buckets=TIME_BUCKETS):
+        h = self.histograms.get(name)
+        if not h:
+            h = self.histograms[name] = Histogram(buckets)
+        h.observe(value)
+
+    def to_dict(self):
+        return dict(name=self.name,
+                    counters=self.counters,
+                    gauges=self.gauges,
+                    histograms=dict((k, h.to_dict())
+                                    for (k, h) in self.histograms.items()))
+
+
+class Registry(object):
+    # the stats of the process
+
+    def __init__(self):
+        self.sessions = []
+        self.start_time = time.time()
+        self.startup_time = None # seconds until the reactor ran
+
+    def session(self, name):
+        s = Stats(name)
+        self.sessions.append(s)
+        return s
+
+    def aggregate(self):
+        # sum the counters and merge the histograms of all sessions,
+        # the additive gauges are summed too
+        total = Stats('process')
+        for s in self.sessions:
+            for k, v in s.counters.items():
+                total.incr(k, v)
+            for k, v in s.gauges.items():
+                if k in ADDITIVE_GAUGES and v is not None:
+                    total.gauges[k] = total.gauges.get(k, 0) + v
+            for k, h in s.histograms.items():
+                if not total.histograms.has_key(k):
+                    total.histograms[k] = Histogram(h.buckets)
+                total.histograms[k].merge(h)
+        return total
+
+    def to_dict(self, sessions=True):
+        d = dict(time=time.time(), uptime=time.time() - self.start_time,
+                 startup_time=self.startup_time,
+                 process=self.aggregate().to_dict())
+        if sessions:
+            d['sessions'] = [s.to_dict() for s in self.sessions]
+        return d
+
+
+registry = Registry()
+
+
+class StatsResource(resource.Resource):
+    # GET / returns the stats as JSON, ?sessions=0 for the process only
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        sessions = request.args.get('sessions', ['1'])[0] != '0'
+        request.setHeader('Content-Type', 'application/json')
+        return json.dumps(self.registry.to_dict(sessions))
+
+
+def serve(port, registry=registry):
+    # serve the stats on localhost:port
+    site = server.Site(StatsResource(registry))
+    site.log = lambda request: None
+    logging.info("Serving stats on http://127.0.0.1:%d/" % port)
+    return reactor.listenTCP(port, site, interface='127.0.0.1')
+
+
+def dump(path, interval, registry=registry):
+    # write the stats as JSON to path every interval seconds
+    def write():
+        tmp = path + '.tmp'
+        f = open(tmp, 'w')
+        try:
+            json.dump(registry.to_dict(), f)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    t = task.LoopingCall(write)
+    t.start(interval, False)
+    reactor.addSystemEventTrigger('before', 'shutdown', write)
+    return t
@@ -0,0 +1,134 @@
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+import logging
+import time
+
+from twisted.internet import defer, reactor
+from twisted.python import log
+
+
+class VirtualViewer(object):
+    # play the segments of a fetcher at real-time pace, without decoding
+    # nor storing them, and measure the viewing experience
+
+    def __init__(self, fetcher, name=None):
+        self.fetcher = fetcher
+        self.fetcher.n_segments_keep = -1 # the viewer deletes what it played
+        self.fetcher.discard = True
+        self.name = name or fetcher.url
+        self.finished = defer.Deferred()
+
+        self.start_time = None
+        self.first_segment_time = None # seconds from start to first segment
+        self.rebuffers = 0
+        self.rebuffer_time = 0.0
+        self.played = 0.0 # seconds of media played
+        self._sequence = None
+        self._stall_start = None
+        self._call = None
+
+    def start(self):
+        self.start_time = time.time()
+        d = self.fetcher.start()
+        d.addCallback(self._started)
+        d.addErrback(self._failed)
+        return d
+
+    def stop(self):
+        if self._call and self._call.active():
+            self._call.cancel()
+        self._call = None
+        self.fetcher.stop()
+        if not self.finished.called:
+            self.finished.callback(self)
+
+    def _failed(self, e):
+        log.err(e)
+        self.stop()
+
+    def _started(self, first_file):
+        (path, url, f) = first_file
+        self.first_segment_time = time.time() - self.start_time
+        self.fetcher.stats.set('first_segment_time', self.first_segment_time)
+        self._play(f.sequence, f.duration)
+
+    def _play(self, sequence, duration):
+        if self._stall_start is not None:
+            stall = time.time() - self._stall_start
+            self.rebuffer_time += stall
+            self.fetcher.stats.incr('rebuffers')
+            self.fetcher.stats.observe('rebuffer_time', stall)
+            self._stall_start = None
+        self._sequence = sequence
+        self.played += duration
+        self.fetcher.stats.set('played', self.played)
+        self._call = reactor.callLater(duration, self._next)
+
+    def _next(self):
+        self._call = None
+        self.fetcher.delete_cache(self._sequence)
+        sequence = self._sequence + 1
+        if self.fetcher.ended(sequence):
+            logging.info("%s: end of media" % self.name)
+            self.stop()
+            return
+        d = self.fetcher.get_segment(sequence)
+        if not d.called:
+            logging.debug("%s: rebuffering at %r" % (self.name, sequence))
+            self.rebuffers += 1
+            self._stall_start = time.time()
+        d.addCallback(lambda x: self._play(x[0], x[2]))
+        d.addErrback(self._failed)
+
+    def bitrate(self):
+        # the achieved bitrate, in bits per second of media played
+        if not self.played:
+            return 0
+        return 8 * self.fetcher.bytes_received / self.played
+
+    def report(self):
+        rebuffer_time = self.rebuffer_time
+        if self._stall_start is not None:
+            rebuffer_time += time.time() - self._stall_start
+        return dict(first_segment_time=self.first_segment_time,
+                    rebuffers=self.rebuffers,
+                    rebuffer_time=rebuffer_time,
+                    played=self.played,
+                    bitrate=self.bitrate())
+
+
+def print_report(viewers):
+    # print the per session metrics, and a summary of all the sessions
+    reports = [v.report() for v in viewers]
+    for v, r in zip(viewers, reports):
+        first = r['first_segment_time']
+        if first is not None:
+            first = '%.3f s' % first
+        logging.info("%s: first segment %s, %d rebuffers (%.1f s), "
+                     "played %.1f s at %d bps" % (v.name,
+                     first, r['rebuffers'],
+                     r['rebuffer_time'], r['played'], r['bitrate']))
+    started = [r['first_segment_time'] for r in reports
+               if r['first_segment_time'] is not None]
+    print "sessions: %d, started: %d" % (len(reports), len(started))
+    if started:
+        started.sort()
+        print "first segment: avg %.3f s, median %.3f s, max %.3f s" % (
+            sum(started) / len(started), started[len(started) / 2], started[-1])
+    print "rebuffers: %d, %.1f s" % (sum(r['rebuffers'] for r in reports),
+                                     sum(r['rebuffer_time'] for r in reports))
+    played = sum(r['played'] for r in reports)
+    if played:
+        print "bitrate: avg %d bps" % (
+            sum(r['bitrate'] * r['played'] for r in reports) / played)
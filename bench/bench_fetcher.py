@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+# Run sessions of the fetcher against a local origin (HLS/origin.py,
+# started in its own process), and report the startup latency, the
+# throughput, the playlist requests, and the CPU and memory per session.
+
+import json
+import logging
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import time
+import urllib2
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from twisted.internet import reactor
+
+from HLS import scheduler
+from HLS.fetcher import HLSFetcher
+from HLS.viewer import VirtualViewer
+
+
+def start_origin(options):
+    args = [sys.executable, '-m', 'HLS.origin', '--port', str(options.port),
+            '--duration', str(options.segment_duration),
+            '--latency', str(options.latency),
+            '--error-rate', str(options.error_rate)]
+    if options.vod:
+        args += ['--vod', '--segments', str(options.segments)]
+    if options.segment_size:
+        args += ['--segment-size', str(options.segment_size)]
+    if options.bandwidth:
+        args += ['--bandwidth', str(options.bandwidth)]
+    if options.plain_playlists:
+        args += ['--plain-playlists']
+    p = subprocess.Popen(args, cwd=ROOT, stdout=subprocess.PIPE)
+    p.stdout.readline() # wait until it serves
+    return p
+
+
+def origin_stats(options):
+    url = 'http://127.0.0.1:%d/stats' % options.port
+    return json.loads(urllib2.urlopen(url).read())
+
+
+def usage():
+    r = resource.getrusage(resource.RUSAGE_SELF)
+    return r.ru_utime + r.ru_stime, r.ru_maxrss
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--sessions', action="store",
+                      dest='sessions', default=50, type="int",
+                      help='number of sessions (default: %default)')
+    parser.add_option('-d', '--duration', action="store",
+                      dest='duration', default=30, type="float",
+                      help='seconds to run (default: %default)')
+    parser.add_option('--vod', action="store_true",
+                      dest='vod', default=False,
+                      help='on-demand instead of live playlists')
+    parser.add_option('--segments', action="store",
+                      dest='segments', default=30, type="int",
+                      help='segments of the on-demand playlists (default: %default)')
+    parser.add_option('-t', '--segment-duration', action="store",
+                      dest='segment_duration', default=2, type="int",
+                      help='segment duration in seconds (default: %default)')
+    parser.add_option('-s', '--segment-size', action="store",
+                      dest='segment_size', default=None, type="int",
+                      help='segment size in bytes (default: from the bitrate)')
+    parser.add_option('-l', '--latency', action="store",
+                      dest='latency', default=0.0, type="float",
+                      help='origin latency in seconds (default: %default)')
+    parser.add_option('-B', '--bandwidth', action="store",
+                      dest='bandwidth', default=None, type="int",
+                      help='origin bytes per second per response (default: unlimited)')
+    parser.add_option('-e', '--error-rate', action="store",
+                      dest='error_rate', default=0.0, type="float",
+                      help='origin error probability (default: %default)')
+    parser.add_option('-b', '--bitrate', action="store",
+                      dest='bitrate', default=200000, type="int",
+                      help='desired bitrate (default: %default)')
+    parser.add_option('-u', '--buffer', action="store",
+                      dest='buffer', default='3',
+                      help='low buffer watermark, in segments or seconds as in 10s (default: %default)')
+    parser.add_option('--max-buffer', action="store",
+                      dest='max_buffer', default=None,
+                      help='high buffer watermark (default: twice the buffer)')
+    parser.add_option('-P', '--parallel', action="store",
+                      dest='parallel', default=3, type="int",
+                      help='parallel downloads per session (default: %default)')
+    parser.add_option('-C', '--connections', action="store",
+                      dest='connections', default=4, type="int",
+                      help='connections per host of each session (default: %default)')
+    parser.add_option('-a', '--abr', action="store_true",
+                      dest='abr', default=False,
+                      help='adapt the bitrate (default: %default)')
+    parser.add_option('-F', '--fast-start', action="store_true",
+                      dest='fast_start', default=False,
+                      help='start the sessions fast (default: %default)')
+    parser.add_option('-R', '--rate', action="store",
+                      dest='rate', default=None, type="int",
+                      help='bits per second of all the sessions (default: unlimited)')
+    parser.add_option('--session-rate', action="store",
+                      dest='session_rate', default=None, type="int",
+                      help='bits per second of each session (default: unlimited)')
+    parser.add_option('--plain-playlists', action="store_true",
+                      dest='plain_playlists', default=False,
+                      help='origin playlists without validators nor gzip '
+                      '(default: %default)')
+    parser.add_option('-p', '--port', action="store",
+                      dest='port', default=18080, type="int",
+                      help='origin port (default: %default)')
+    options, args = parser.parse_args()
+    options.path = None
+    options.referer = None
+    options.keep = 0
+    options.cache_size = 0
+    options.start = None
+    logging.basicConfig(level=logging.WARNING)
+    scheduler.bandwidth.configure(options.rate, options.session_rate)
+
+    origin = start_origin(options)
+    try:
+        url = 'http://127.0.0.1:%d/master.m3u8' % options.port
+        viewers = []
+        for i in range(options.sessions):
+            v = VirtualViewer(HLSFetcher(url, options), 'session %d' % i)
+            viewers.append(v)
+            reactor.callWhenRunning(v.start)
+
+        cpu, rss = usage()
+        start = time.time()
+        reactor.callLater(options.duration, reactor.stop)
+        reactor.run()
+        elapsed = time.time() - start
+        cpu = usage()[0] - cpu
+        rss = usage()[1] - rss
+        stats = origin_stats(options)
+    finally:
+        origin.terminate()
+        origin.wait()
+
+    n = len(viewers)
+    started = sorted(v.first_segment_time for v in viewers
+                     if v.first_segment_time is not None)
+    received = sum(v.fetcher.bytes_received for v in viewers)
+    print 'sessions:            %d (%d started) for %.1f s' % (
+        n, len(started), elapsed)
+    if started:
+        print 'startup latency:     avg %.3f s, median %.3f s, max %.3f s' % (
+            sum(started) / len(started), started[len(started) / 2],
+            started[-1])
+    print 'throughput:          %.0f kbit/s, %.0f kbit/s per session' % (
+        8 * received / elapsed / 1000, 8 * received / elapsed / 1000 / n)
+    print 'rebuffers:           %d, %.1f s' % (
+        sum(v.rebuffers for v in viewers),
+        sum(v.report()['rebuffer_time'] for v in viewers))
+    print 'playlist requests:   %d, %.1f per session per minute' % (
+        stats['requests']['playlist'],
+        stats['requests']['playlist'] * 60.0 / elapsed / n)
+    print 'playlist traffic:    %.1f kB, %d not modified' % (
+        stats['playlist_bytes_sent'] / 1000.0,
+        stats['requests']['not_modified'])
+    print 'segment requests:    %d (%d errors)' % (
+        stats['requests']['segment'], stats['requests']['error'])
+    print 'cpu per session:     %.2f ms/s' % (1000 * cpu / elapsed / n)
+    print 'memory per session:  %.1f kB' % (float(rss) / n)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
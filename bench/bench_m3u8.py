@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+# Simulate the reloads of a live playlist over several days, and report
+# the parse time and the memory used by the M3U8 along the run.
+
+import gc
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from HLS.m3u8 import M3U8
+
+
+def live_playlist(sequence, window, duration):
+    lines = ['#EXTM3U',
+             '#EXT-X-TARGETDURATION:%d' % duration,
+             '#EXT-X-MEDIA-SEQUENCE:%d' % sequence]
+    for i in range(sequence, sequence + window):
+        lines.append('#EXTINF:%d,' % duration)
+        lines.append('http://origin.example.com/live/segment-%d.ts' % i)
+    return '\n'.join(lines) + '\n'
+
+
+def rss():
+    # resident memory in kB, on Linux
+    try:
+        for l in open('/proc/self/status'):
+            if l.startswith('VmRSS:'):
+                return int(l.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-d', '--days', action="store",
+                      dest='days', default=3, type="float",
+                      help='simulated days of live (default: %default)')
+    parser.add_option('-w', '--window', action="store",
+                      dest='window', default=6, type="int",
+                      help='segments in the live window (default: %default)')
+    parser.add_option('-t', '--duration', action="store",
+                      dest='duration', default=10, type="int",
+                      help='segment duration in seconds (default: %default)')
+    options, args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    n = int(options.days * 86400 / options.duration)
+    report = max(1, n / 12)
+    pl = M3U8('http://origin.example.com/live/index.m3u8')
+    start_rss = rss()
+    parse_time = 0.0
+    print '%10s %10s %10s %12s %10s' % ('hours', 'reloads', 'files',
+                                        'us/reload', 'rss kB')
+    for i in xrange(n):
+        content = live_playlist(i, options.window, options.duration)
+        t = time.time()
+        pl.update(content)
+        # the unchanged reload, after half the target duration
+        pl.update(content)
+        parse_time += time.time() - t
+        if (i + 1) % report == 0:
+            gc.collect()
+            print '%10.1f %10d %10d %12.1f %10d' % (
+                (i + 1) * options.duration / 3600.0, 2 * (i + 1),
+                len(pl._files), parse_time * 1e6 / (2 * (i + 1)), rss())
+    print 'rss growth: %d kB' % (rss() - start_rss)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
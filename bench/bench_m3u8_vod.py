@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- Mode: Python -*-
+# vi:si:et:sw=4:sts=4:ts=4
+#
+# Copyright (C) 2009-2010 Fluendo, S.L. (www.fluendo.com).
+# Copyright (C) 2009-2010 Marc-Andre Lureau <marcandre.lureau@gmail.com>
+
+# This file may be distributed and/or modified under the terms of
+# the GNU General Public License version 2 as published by
+# the Free Software Foundation.
+# This file is distributed without any warranty; without even the implied
+# warranty of merchantability or fitness for a particular purpose.
+# See "LICENSE" in the source distribution for more information.
+
+# Parse large on-demand playlists with the full parser and the fast one,
+# and report the parse time, the memory held by the M3U8 and the time to
+# walk its segments. Each parse runs in a child process, so that the
+# memory of one does not hide the other's.
+
+import gc
+import json
+import logging
+import optparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+from HLS.m3u8 import M3U8
+
+
+def vod_playlist(n, duration):
+    lines = ['#EXTM3U',
+             '#EXT-X-VERSION:3',
+             '#EXT-X-TARGETDURATION:%d' % duration,
+             '#EXT-X-MEDIA-SEQUENCE:0',
+             '#EXT-X-PLAYLIST-TYPE:VOD']
+    for i in xrange(n):
+        lines.append('#EXTINF:%.3f,' % (duration - (i % 7) * 0.04))
+        lines.append('http://origin.example.com/vod/asset/720p/segment-%d.ts' % i)
+    lines.append('#EXT-X-ENDLIST')
+    return '\n'.join(lines) + '\n'
+
+
+def rss():
+    # resident memory in kB, on Linux
+    try:
+        for l in open('/proc/self/status'):
+            if l.startswith('VmRSS:'):
+                return int(l.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def measure(content, fast):
+    M3U8.FAST_PARSE = fast
+    gc.collect()
+    start_rss = rss()
+    t = time.time()
+    pl = M3U8('http://origin.example.com/vod/asset/720p/index.m3u8')
+    pl.update(content)
+    parse_time = time.time() - t
+    gc.collect()
+    memory = rss() - start_rss
+    t = time.time()
+    for f in pl.iter_files():
+        pass
+    walk_time = time.time() - t
+    return dict(parse=parse_time, memory=memory, walk=walk_time)
+
+
+def run_child(content, fast):
+    # measure in a child process, return its result
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        # the full parser prints the tags it doesn't know
+        sys.stdout = open(os.devnull, 'w')
+        os.write(w, json.dumps(measure(content, fast)))
+        os._exit(0)
+    os.close(w)
+    data = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    os.waitpid(pid, 0)
+    return json.loads(data)
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--segments', action="store",
+                      dest='segments', default='50000,100000,200000',
+                      help='comma separated playlist sizes (default: %default)')
+    parser.add_option('-t', '--duration', action="store",
+                      dest='duration', default=6, type="int",
+                      help='segment duration in seconds (default: %default)')
+    options, args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    print '%10s %8s %10s %10s %10s' % ('segments', 'parser', 'parse s',
+                                        'rss kB', 'walk s')
+    for n in [int(x) for x in options.segments.split(',')]:
+        content = vod_playlist(n, options.duration)
+        for (name, fast) in (('full', False), ('fast', True)):
+            r = run_child(content, fast)
+            print '%10d %8s %10.3f %10d %10.3f' % (n, name, r['parse'],
+                                                   r['memory'], r['walk'])
+
+
+if __name__ == '__main__':
+    sys.exit(main())